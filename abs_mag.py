@@ -4,6 +4,7 @@ three different options for integration (for testing purposes).
 1) prop_dist_reim() - Simple Reimann sum with small steps.
 2) prop_dist_trap() - Trapezoid method
 3) prop_dist_simp() - Simpson's method
+prop_dist_arr() is the vectorized version of these for arrays of redshifts.
 """
 
 from astropy.io import fits
@@ -11,7 +12,13 @@ import numpy as np
 import fits_writer_error_trap as fet
 import progressBar as pb
 import tmark
-import sys
+import cosmo_calc as csm
+import shared_pool as spl
+import fast_match as fm
+import os
+import glob
+import json
+import argparse
 
 #USES FLAT COSMOLOGY WITH COSMOLOGICAL CONSTANT: BENCHMARK MODEL
 #Define a number of used constants, taken 20180314 from Ned Wright's page.
@@ -23,12 +30,18 @@ omegaM = 0.286
 omegaR = 9.0e-5
 omegaL = 1.0 - omegaR - omegaM
 '''
-#These are the values Isabelle used in DR14Q
+#These are the values Isabelle used in DR14Q. They are also available without
+#editing this file as cosmo_calc.DR14Q, made flat there (and mine as cosmo_calc.DR15Q).
 h0 = 67.8 #Hubble Constant
 omegaM = 0.308 #Matter density parameter
 omegaR = 9.0e-5 #radiation density parameter
 omegaL = 0.692 #Vacuum density parameter
 '''
+#Default output file (without the .fits) for get_mags, and the key columns that
+#go in a sidecar file.
+def_ofile = '../../data/newq/DRNQ_v1_8_wisemags'
+side_keys = ['PLATE','MJD','FIBERID']
+
 #Common constants for both me and Isabelle.
 #alphaV = -0.5
 c = 299792.458 #speed of light in km/s
@@ -98,6 +111,14 @@ def prop_dist_simp(z_p):
     dPS = (dz / 3.0) * dpS #Last step of Simpson's Method.
     return dPS
 
+#Vectorized proper distance for a whole array of redshifts at once. Uses the
+#Gauss-Legendre engine in cosmo_calc, but with the cosmology defined here. Pass
+#a cosmo_calc.Cosmology as cosmo to use that instead (and its cached table).
+def prop_dist_arr(z_arr,cosmo=None):
+    if cosmo is not None:
+        return cosmo.comove_dist(z_arr)
+    return csm.gl_integral(z_func,0.0,z_arr)
+
 #Calculate the Luminosity distance from proper distance and redshift.
 def lum_dist(dp,z_l):
     #dp must in input as Mpc
@@ -113,13 +134,10 @@ def dist_mod(dl):
     #alphaV is defined above.
     #return -2.5*(1+alphaV)*np.log10(1+z_k) #unitless
 
-def k_corr(z_k):
-    k_table = np.loadtxt('k_corr_tab.dat',dtype='f4',delimiter=',') #Load k-correction table
-    diff_arr = np.absolute(z_k - k_table[:,0])
-    min_diff = np.amin(diff_arr)
-    wmin = np.where(diff_arr == min_diff)[0]
-    kC = k_table[wmin[0],1]
-    return kC
+#The k-correction table lookup is shared with cosmo_calc, which loads the table
+#once and can take an array of redshifts.
+def k_corr(z_k,interp='nearest'):
+    return csm.k_corr(z_k,interp=interp)
 
 #Find the absolute magnitude given the previously calculated values and data
 #taken from the fits file.
@@ -128,60 +146,488 @@ def abs_Mag(apmag,ext,dm,kC):
     #dm is distance modulus from dist_mod, and kC is k correction from k_corr.
     return apmag - ext - dm - kC #unitless
 
+#The cosmology defined at the top of this file, as a cosmo_calc.Cosmology. Its
+#distance table is shared with any other Cosmology using the same parameters.
+def get_cosmo():
+    return csm.Cosmology(h0,omegaM,omegaR,omegaL)
+
+#Distance moduli for every good redshift (Z >= 0) in one vectorized call.
+#Returns the mask of good redshifts and their distance moduli.
+def dist_mods(z_arr,norml=False,cosmo=None):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    z_arr = np.asarray(z_arr,dtype='f8')
+    wgood = z_arr >= 0
+    if (norml==False):
+        z_temp = z_arr[wgood]
+    else:
+        z_temp = np.full(np.count_nonzero(wgood),2.0)
+    Dl = cosmo.lum_dist(z_temp) #luminosity distances from the cached table
+    return wgood,dist_mod(Dl)
+
+#Columnar version of the absolute magnitude calculation. z_arr, appmag, and ext
+#are whole columns (redshift, apparent i-band PSF magnitude, and i-band
+#extinction). All of the distance moduli are found in one vectorized call.
+#Objects with a bad redshift (Z < 0, blazars and such) get 0, as before.
+def calc_mags(z_arr,appmag,ext,norml=False,cosmo=None):
+    magarr = np.zeros(len(z_arr),dtype='f4') #Bad redshifts stay 0.
+    wgood,Dm = dist_mods(z_arr,norml=norml,cosmo=cosmo)
+    #Kc = k_corr(z_temp) #This is for K-correction using record Z.
+    Kc = k_corr(2.0) #This is the standard way of finding K-correction.
+    magarr[wgood] = abs_Mag(np.asarray(appmag)[wgood],np.asarray(ext)[wgood],Dm,Kc)
+    return magarr
+
+#Multi-band version of calc_mags. psfmag and ext are the full 5 band PSFMAG and
+#EXTINCTION columns (ugriz order), bands picks which ones to do. The distance
+#modulus is shared by all bands and each band's k-correction comes from
+#cosmo_calc.k_corr_band (its table is only loaded once). Bands without a table
+#need kc_fallback='powerlaw'. Returns an array of shape (number of records,
+#number of bands).
+def calc_mags_bands(z_arr,psfmag,ext,bands='ugriz',norml=False,cosmo=None,kc_fallback=None):
+    band_adr = [csm.band_list.index(band) for band in bands]
+    magarr = np.zeros((len(z_arr),len(bands)),dtype='f4') #Bad redshifts stay 0.
+    wgood,Dm = dist_mods(z_arr,norml=norml,cosmo=cosmo)
+    Kc = np.array([csm.k_corr_band(2.0,band,fallback=kc_fallback) for band in bands])
+    psfmag,ext = np.asarray(psfmag)[wgood],np.asarray(ext)[wgood]
+    magarr[wgood] = abs_Mag(psfmag[:,band_adr],ext[:,band_adr],Dm[:,None],Kc)
+    return magarr
+
+#The new column for a set of bands. The i-band alone is the m_i column as it
+#always has been, more than one band is m_<bands> with one entry per band.
+def mag_col(bands='i'):
+    if bands == 'i':
+        return 'm_i','E'
+    return 'm_{}'.format(bands),'{}E'.format(len(bands))
+
+#Header cards recording the k-correction used for each band (KCORR_<band> is
+#TABLE or POWERLAW), so the output says which convention its magnitudes follow.
+#Raises before any work is done if a band has no table and no fallback.
+def kcorr_cards(bands='i',kc_fallback=None):
+    cards = []
+    for band in bands:
+        kind = csm.kcorr_kind(band,fallback=kc_fallback)
+        if kind == 'table':
+            note = 'k-corr from {}'.format(os.path.basename(csm.kcorr_band_file(band)))
+        else:
+            note = 'k-corr power law, alpha={}'.format(csm.alphaV)
+        cards.append(('KCORR_{}'.format(band.upper()),kind.upper(),note))
+    return cards
+
+#Runs calc_mags (i-band) or calc_mags_bands on full PSFMAG and EXTINCTION columns.
+def band_mags(z_col,psfmag,ext,bands='i',norml=False,cosmo=None,kc_fallback=None):
+    if bands == 'i':
+        return calc_mags(z_col,psfmag[:,3],ext[:,3],norml=norml,cosmo=cosmo)
+    return calc_mags_bands(z_col,psfmag,ext,bands=bands,norml=norml,cosmo=cosmo,
+                           kc_fallback=kc_fallback)
+
+#Magnitudes for one set of rows, serially or over a pool of workers. pool is an
+#open pool from spl.open_pool to reuse when this is called once per chunk.
+def mags_part(z_col,psfmag,ext,bands='i',norml=False,cosmo=None,workers=1,pool=None,
+              kc_fallback=None):
+    if workers > 1:
+        out_type = 'f4' if bands == 'i' else ('f4',len(bands))
+        return spl.pool_run(band_mags,[z_col,psfmag,ext],[out_type],workers,
+                            kwargs={'bands':bands,'norml':norml,'cosmo':cosmo,
+                                    'kc_fallback':kc_fallback},pool=pool)[0]
+    return band_mags(z_col,psfmag,ext,bands=bands,norml=norml,cosmo=cosmo,kc_fallback=kc_fallback)
+
+#Checkpoints for long runs. Each chunk of magnitudes is saved to ckpt_dir as soon
+#as it is done (mags_<first row>.npy, written to a temporary name and renamed so
+#a crash never leaves half a chunk), along with a ckpt_meta.json describing the
+#run. With resume=True, chunks already in ckpt_dir are loaded instead of being
+#calculated again. The checkpoint is removed once the output file is written.
+ckpt_meta_name = 'ckpt_meta.json'
+
+#What has to match for a checkpoint to be reused: the input file (and that it
+#hasn't changed), the chunking, and everything that goes into the magnitudes.
+def ckpt_meta(ifile,num_rec,chunk,bands,norml,cosmo):
+    fstat = os.stat(ifile)
+    return {'ifile':os.path.abspath(ifile),'size':fstat.st_size,'mtime':fstat.st_mtime,
+            'num_rec':int(num_rec),'chunk':int(chunk),'bands':bands,'norml':bool(norml),
+            'cosmo':list(cosmo.key())}
+
+def ckpt_files(ckpt_dir):
+    return [fname for fname in glob.glob(os.path.join(ckpt_dir,'mags_*.npy'))
+            if not fname.endswith('.tmp.npy')]
+
+#Sets up ckpt_dir for a run. Without resume any old checkpoint there is cleared.
+def ckpt_open(ckpt_dir,meta,resume=False):
+    os.makedirs(ckpt_dir,exist_ok=True)
+    mname = os.path.join(ckpt_dir,ckpt_meta_name)
+    if (resume == True) & os.path.exists(mname):
+        with open(mname) as mf:
+            old_meta = json.load(mf)
+        if old_meta != meta:
+            raise ValueError('Checkpoint in {} is from a different run, remove it or '
+                             'run without resume'.format(ckpt_dir))
+        print('Resuming from {}: {} chunks already done'.format(ckpt_dir,len(ckpt_files(ckpt_dir))))
+        return
+    ckpt_clear(ckpt_dir,rm_dir=False)
+    with open(mname,'w') as mf:
+        json.dump(meta,mf)
+
+#Returns func(*args,**kwargs) for the chunk starting at row start, from the
+#checkpoint if it's there. Saves it if not. ckpt_dir=None just calls func.
+def ckpt_chunk(ckpt_dir,start,func,*args,**kwargs):
+    if ckpt_dir is None:
+        return func(*args,**kwargs)
+    cname = os.path.join(ckpt_dir,'mags_{:012d}.npy'.format(start))
+    if os.path.exists(cname):
+        return np.load(cname)
+    res = func(*args,**kwargs)
+    tmp_name = '{}.{}.tmp.npy'.format(cname[:-4],os.getpid())
+    np.save(tmp_name,res)
+    os.replace(tmp_name,cname)
+    return res
+
+def ckpt_clear(ckpt_dir,rm_dir=True):
+    for fname in glob.glob(os.path.join(ckpt_dir,'mags_*.npy')) + [os.path.join(ckpt_dir,ckpt_meta_name)]:
+        if os.path.exists(fname):
+            os.remove(fname)
+    if rm_dir == True:
+        try:
+            os.rmdir(ckpt_dir)
+        except OSError: #Something else is in there, leave it.
+            pass
+
 #Primary program for reading the FITS file and calculating redshift for all records.
 #ifile is the input fits file. norml is for normalizing all of the records to
-#redshift of 2.0. Not really used.
-def get_mags(ifile,norml=False):
+#redshift of 2.0. Not really used. Giving a chunk_size streams the catalog
+#through get_mags_stream instead of loading it all at once. workers > 1 splits
+#the calculation over a pool of processes (see shared_pool), streamed or not.
+#ofile is the output name without the .fits. sidecar=True writes only the
+#PLATE/MJD/FIBERID key and m_i to ofile instead of rewriting the whole catalog
+#(see write_sidecar and read_sidecar). bands='ugriz' (or any subset) does all of
+#those bands in one pass, see calc_mags_bands. Bands without a k-correction table
+#need kc_fallback='powerlaw', and the output header records each band's
+#k-correction (see kcorr_cards).
+#ckpt_dir turns on checkpointing: the magnitudes are done ckpt_size rows at a time
+#(chunk_size when streaming) and each chunk is saved there as it finishes. One
+#pool of workers is started for the whole run and shared by all the chunks.
+#resume=True picks up from the chunks already saved by a run that was killed
+#(ckpt_dir defaults to <ofile>_ckpt then). Returns the name of the file written.
+def get_mags(ifile,norml=False,chunk_size=None,workers=1,ofile=def_ofile,sidecar=False,
+             bands='i',ckpt_dir=None,ckpt_size=100000,resume=False,kc_fallback=None):
     #norml means normalized all to the same redshift (z=2) if true.
     #If norml is false, uses the best redshift from the catalogue ('Z').
+    if (resume == True) & (ckpt_dir is None):
+        ckpt_dir = '{}_ckpt'.format(ofile)
+    if chunk_size is not None:
+        return get_mags_stream(ifile,ofile,chunk_size=chunk_size,norml=norml,
+                               sidecar=sidecar,bands=bands,ckpt_dir=ckpt_dir,resume=resume,
+                               workers=workers,kc_fallback=kc_fallback)
+    kc_cards = kcorr_cards(bands,kc_fallback=kc_fallback)
     drfile = fits.open(ifile)[1].data #Load the FITS file.
-    num_rec = len(drfile) #Find the number of records.
-    magarr = np.zeros(num_rec,dtype='f4') #Create an array to hold absolute magnitude
-    magarr[:] = 999 #replace all of them with 999. If 999 appears afterwards I missed that record.
     tmark.tm('Starting Absolute Magnitude Calculations')
-    #Iterate through all objects.
-    for i in range(num_rec):
-        #Define the redshift for the object
-        rec_z = drfile['Z'][i] #Current working redshift.
-        if rec_z < 0:
-            magarr[i] = 0 #This catches blazars or other objects with a bad Z.
-            continue
-        if (norml==False):
-            z_temp = rec_z
-        else:
-            z_temp = 2.0
-        appMag = drfile['PSFMAG'][i,3] #apparent PSF magnitude in i-band
-        A_i = drfile['EXTINCTION'][i,3] #galactic extinction in magnitudes (i-band)
-        Dp = prop_dist_simp(z_temp) #find the proper distance using simpson's method
-        Dl = lum_dist(Dp,z_temp) #find the luminosity distance
-        Dm = dist_mod(Dl)
-        #Kc = k_corr(z_temp) #This is for K-correction using record Z.
-        Kc = k_corr(2.0) #This is the standard way of finding K-correction.
-        absMag = abs_Mag(appMag,A_i,Dm,Kc) #get the Absolute magnitude in i-band.
-        magarr[i] = absMag #Save it to placeholder array
-
-        pb.pbar(i,num_rec)
-        #The following two lines are for testing purposes. Comment if you don't want
-        #to print interim values.
-        #test_str = 'Z: {0:6.4f} | Dp: {1:6.1f} | Dl: {2:7.1f} | Mag: {3:9.5f}'.format(z_temp,Dp,Dl,absMag)
-        #print(test_str)
+    #Read each needed column once, then do every record at the same time.
+    z_col = drfile['Z']
+    appMag = drfile['PSFMAG'] #apparent PSF magnitudes
+    A_i = drfile['EXTINCTION'] #galactic extinction in magnitudes
+    cosmo = get_cosmo()
+    if workers > 1:
+        cosmo.table() #Build (and save) the table once, so the workers just load it.
+    if ckpt_dir is None:
+        magarr = mags_part(z_col,appMag,A_i,bands=bands,norml=norml,cosmo=cosmo,workers=workers,
+                           kc_fallback=kc_fallback)
+    else:
+        num_rec = len(z_col)
+        ckpt_open(ckpt_dir,ckpt_meta(ifile,num_rec,ckpt_size,bands,norml,cosmo),resume=resume)
+        magarr = np.zeros((num_rec,) if bands == 'i' else (num_rec,len(bands)),dtype='f4')
+        with spl.open_pool(workers) as pool:
+            for i in range(0,num_rec,ckpt_size):
+                rsl = slice(i,i+ckpt_size)
+                magarr[rsl] = ckpt_chunk(ckpt_dir,i,mags_part,z_col[rsl],appMag[rsl],A_i[rsl],
+                                         bands=bands,norml=norml,cosmo=cosmo,workers=workers,pool=pool,
+                                         kc_fallback=kc_fallback)
+                pb.pbar(min(i+ckpt_size,num_rec)-1,num_rec)
+    mag_name,mag_form = mag_col(bands)
 
     #User feedback for when the program completes.
     print('\n')
     print('Absolute Magnitudes Calculated')
+    if sidecar == True:
+        out_name = write_sidecar(drfile,{mag_name:magarr},ofile,cards=kc_cards)
+        if ckpt_dir is not None:
+            ckpt_clear(ckpt_dir)
+        return out_name
     #The following writes out the new fits record with the absolute magnitude column.
 
     #Need to place the new column in the right place, between PSFMAGERR and EXTINCTION
-    colnames = np.array(drfile.columns.names) #Make an array of all current column names.
-    wpsf = np.where(colnames=='psfmagerr')[0] #Find column address of PSFMAGERR
-    psfmagerr_adr = wpsf[0] + 1 #Move one beyond that. If you don't have this, you remove PSFMAGERR column
+    psfmagerr_adr = mag_col_adr(drfile.columns) #Column address just past PSFMAGERR
     data_col1 = drfile.columns[0:psfmagerr_adr] #Old original columns.
     data_col2 = drfile.columns[psfmagerr_adr:] #Columns to shift after absMag column.
-    magCol = fits.ColDefs([fits.Column(name='m_i',format='E',array=magarr)]) #New column definition.
+    magCol = fits.ColDefs([fits.Column(name=mag_name,format=mag_form,array=magarr)]) #New column definition.
 
     #Put together the HDU and write out the file using my fits_writer_error_trap function.
     data_out = fits.BinTableHDU.from_columns(data_col1 + magCol + data_col2)
-    ofile = '../../data/newq/DRNQ_v1_8_wisemags'
-    fet.nm_up(data_out,ofile)
+    data_out.header.extend(kc_cards)
+    out_name = fet.nm_up(data_out,ofile)
+    if ckpt_dir is not None:
+        ckpt_clear(ckpt_dir)
+    return out_name
+
+#Monte Carlo version of calc_mags. Each object gets nsamp draws of its apparent
+#magnitude from a normal distribution with width magerr (the PSFMAGERR column),
+#and of its redshift with width zerr if that is given (a Z_ERR style column).
+#Every draw goes through the cached distance table in one vectorized call per
+#chunk of chunk_size objects. Returns a dictionary with the mean, sigma, and
+#percentiles (shape (num objects, len(pcts))) of the absolute magnitude. Bad
+#redshifts (Z < 0) get 0 like calc_mags. seed makes the draws repeatable.
+def mc_mags(z_arr,appmag,ext,magerr,zerr=None,nsamp=1000,pcts=(16,50,84),seed=0,
+            chunk_size=10000,norml=False,cosmo=None):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    rng = np.random.default_rng(seed)
+    z_arr = np.asarray(z_arr,dtype='f8')
+    appmag = np.asarray(appmag,dtype='f8')
+    ext = np.asarray(ext,dtype='f8')
+    magerr = np.maximum(np.asarray(magerr,dtype='f8'),0.0) #Negative errors are flags.
+    if zerr is not None:
+        zerr = np.maximum(np.asarray(zerr,dtype='f8'),0.0)
+    num_rec = len(z_arr)
+    out = {'mean':np.zeros(num_rec,dtype='f4'),'sigma':np.zeros(num_rec,dtype='f4'),
+           'pct':np.zeros((num_rec,len(pcts)),dtype='f4')}
+    Kc = k_corr(2.0) #This is the standard way of finding K-correction.
+    wgood = np.where(z_arr >= 0)[0]
+    for i in range(0,len(wgood),chunk_size):
+        wc = wgood[i:i+chunk_size]
+        z_c = np.full(len(wc),2.0) if norml == True else z_arr[wc]
+        app_s = appmag[wc,None] + magerr[wc,None] * rng.standard_normal((len(wc),nsamp))
+        if (zerr is not None) & (norml == False):
+            #Redshift draws are kept positive, so the distance modulus stays finite.
+            z_s = np.abs(z_c[:,None] + zerr[wc,None] * rng.standard_normal((len(wc),nsamp)))
+            Dm = dist_mod(cosmo.lum_dist(z_s))
+        else:
+            #Without redshift errors the distance modulus is the same for every draw.
+            Dm = dist_mod(cosmo.lum_dist(z_c))[:,None]
+        mag_s = abs_Mag(app_s,ext[wc,None],Dm,Kc)
+        out['mean'][wc] = np.mean(mag_s,axis=1)
+        out['sigma'][wc] = np.std(mag_s,axis=1,ddof=1)
+        out['pct'][wc] = np.percentile(mag_s,pcts,axis=1).T
+    return out
+
+#Runs mc_mags on a whole catalog and writes the results to a sidecar file (see
+#write_sidecar): m_i_mc (mean), m_i_sig, and m_i_pct (the percentiles). zerr_col
+#names a redshift error column to include, if there is one.
+def get_mags_mc(ifile,ofile,nsamp=1000,zerr_col=None,pcts=(16,50,84),seed=0,norml=False):
+    drfile = fits.open(ifile)[1].data
+    tmark.tm('Starting Monte Carlo Absolute Magnitudes')
+    zerr = None if zerr_col is None else drfile[zerr_col]
+    res = mc_mags(drfile['Z'],drfile['PSFMAG'][:,3],drfile['EXTINCTION'][:,3],
+                  drfile['PSFMAGERR'][:,3],zerr=zerr,nsamp=nsamp,pcts=pcts,seed=seed,
+                  norml=norml)
+    return write_sidecar(drfile,{'m_i_mc':res['mean'],'m_i_sig':res['sigma'],
+                                 'm_i_pct':res['pct']},ofile)
+
+#The sidecar file holds just the PLATE/MJD/FIBERID key and the new columns, so
+#adding m_i doesn't mean writing out the whole catalog again. new_cols is a
+#dictionary of column name: array, in the same row order as drfile. Leave
+#drfile as None to get just the column definitions for the key columns.
+def sidecar_cols(in_cols,new_cols,drfile=None):
+    side_cols = [fits.Column(name=col.name,format=col.format,bscale=col.bscale,
+                             bzero=col.bzero,array=None if drfile is None else drfile[col.name])
+                 for col in in_cols if col.name in side_keys]
+    for cname,carr in new_cols.items():
+        side_cols.append(fits.Column(name=cname,format=fits_format(carr),array=carr))
+    return side_cols
+
+def fits_format(arr):
+    fmt = {'f4':'E','f8':'D','i2':'I','i4':'J','i8':'K'}[np.asarray(arr).dtype.str[1:]]
+    if np.ndim(arr) > 1:
+        fmt = '{}{}'.format(np.shape(arr)[1],fmt)
+    return fmt
+
+#cards are extra (keyword, value, comment) header cards for the sidecar.
+def write_sidecar(drfile,new_cols,ofile,cards=()):
+    side_cols = sidecar_cols(drfile.columns,new_cols,drfile=drfile)
+    data_out = fits.BinTableHDU.from_columns(side_cols)
+    data_out.header.extend(cards)
+    return fet.nm_up(data_out,ofile)
+
+#Packs PLATE/MJD/FIBERID into one int64 per row, used to line up the sidecar.
+def side_key(rec):
+    return fm.mk_key(rec)
+
+#Join-on-read. Loads the catalog in ifile and adds the columns in the sidecar
+#file sfile, matched on PLATE/MJD/FIBERID. Catalog rows that aren't in the
+#sidecar get 999, like a record get_mags missed. Returns the joined FITS_rec.
+def read_sidecar(ifile,sfile):
+    cat_hdu = fits.open(ifile)[1]
+    side = fits.open(sfile)[1].data
+    key_cat,key_side = side_key(cat_hdu.data),side_key(side)
+    if np.array_equal(key_cat,key_side):
+        side_adr = np.arange(len(key_cat))
+        wfound = np.ones(len(key_cat),dtype=bool)
+    else:
+        srt = np.argsort(key_side,kind='stable')
+        pos = np.clip(np.searchsorted(key_side[srt],key_cat),0,max(len(srt)-1,0))
+        side_adr = srt[pos] if len(srt) > 0 else pos
+        wfound = (key_side[side_adr] == key_cat) if len(srt) > 0 else np.zeros(len(key_cat),dtype=bool)
+    add_cols = []
+    for col in side.columns:
+        if col.name in side_keys:
+            continue
+        col_arr = np.full((len(key_cat),) + side[col.name].shape[1:],999,dtype=side[col.name].dtype)
+        col_arr[wfound] = side[col.name][side_adr[wfound]]
+        add_cols.append(fits.Column(name=col.name,format=col.format,array=col_arr))
+    return fits.BinTableHDU.from_columns(cat_hdu.columns + fits.ColDefs(add_cols)).data
+
+#Finds the column address one beyond PSFMAGERR, which is where m_i goes.
+#If you don't move one beyond, you remove the PSFMAGERR column.
+def mag_col_adr(coldefs):
+    colnames = np.array(coldefs.names) #Make an array of all current column names.
+    wpsf = np.where(np.char.lower(colnames)=='psfmagerr')[0] #Find column address of PSFMAGERR
+    return wpsf[0] + 1
+
+#Streaming version of get_mags for catalogs bigger than memory. The input table
+#is memory-mapped and read chunk_size rows at a time. Each chunk's magnitudes are
+#calculated, m_i is spliced into the raw rows, and the rows are written straight
+#to ofile (a name without .fits, like get_mags) with astropy's StreamingHDU. Peak
+#memory is a few copies of one chunk no matter how big the catalog is.
+#Tables with variable length (heap) columns can't be streamed this way, and
+#neither can compressed (.gz, .bz2, .zip) files, which have no rows on disk to
+#map; use get_mags without chunk_size for those, or decompress them first.
+#sidecar=True streams just the key columns and m_i, and bands, kc_fallback,
+#ckpt_dir, resume, and workers (one pool for all the chunks) work the same way
+#as in get_mags. The file is streamed to <name>.part and
+#only renamed when it's complete, so a killed run never leaves a file that
+#looks finished.
+def get_mags_stream(ifile,ofile,chunk_size=100000,norml=False,sidecar=False,bands='i',
+                    ckpt_dir=None,resume=False,workers=1,kc_fallback=None):
+    with fits.open(ifile,memmap=True) as hdul:
+        hdr_in = hdul[1].header
+        if hdr_in.get('PCOUNT',0) != 0:
+            raise ValueError('get_mags_stream does not support variable length columns')
+        compression = hdul.fileinfo(1)['file'].compression
+        if compression is not None:
+            raise ValueError('Streaming needs an uncompressed FITS file, {} is {} compressed. '
+                             'Decompress it or run without chunk_size'.format(ifile,compression))
+        num_rec = hdr_in['NAXIS2']
+        row_len = hdr_in['NAXIS1']
+        dat_loc = hdul.fileinfo(1)['datLoc'] #Byte offset of the table data in the file.
+        in_cols = hdul[1].columns
+        in_dtype = in_cols.dtype.newbyteorder('>') #Raw (big-endian) row layout with field offsets.
+        mag_adr = mag_col_adr(in_cols)
+        #Copy the column definitions without touching the data.
+        out_cols = [fits.Column(name=col.name,format=col.format,unit=col.unit,
+                                null=col.null,bscale=col.bscale,bzero=col.bzero,
+                                disp=col.disp,dim=col.dim) for col in in_cols]
+    mag_name,mag_form = mag_col(bands)
+    mag_len = 4 * len(bands) #Bytes per row for the new column.
+    mag_shape = () if bands == 'i' else (len(bands),)
+    out_cols.insert(mag_adr,fits.Column(name=mag_name,format=mag_form))
+    if sidecar == True:
+        out_cols = sidecar_cols(out_cols[:mag_adr] + out_cols[mag_adr+1:],
+                                {mag_name:np.zeros((0,)+mag_shape,dtype='f4')})
+        side_dtype = np.dtype([(col.name,in_dtype[col.name]) for col in out_cols[:-1]]
+                              + [(mag_name,'>f4',mag_shape)])
+    hdr_out = fits.BinTableHDU.from_columns(out_cols,nrows=0).header
+    hdr_out['NAXIS2'] = num_rec
+    hdr_out.extend(kcorr_cards(bands,kc_fallback=kc_fallback))
+    #Byte offset in the row where m_i goes.
+    byte_adr = row_len if mag_adr == len(in_cols) else in_dtype.fields[in_cols.names[mag_adr]][1]
+    cosmo = get_cosmo()
+    if workers > 1:
+        cosmo.table() #Build (and save) the table once, so the workers just load it.
+    if ckpt_dir is not None:
+        ckpt_open(ckpt_dir,ckpt_meta(ifile,num_rec,chunk_size,bands,norml,cosmo),resume=resume)
+
+    raw_in = np.memmap(ifile,dtype='u1',mode='r',offset=dat_loc,shape=(num_rec,row_len))
+    out_name = fet.nm_free(ofile)
+    part_name = '{}.part'.format(out_name)
+    if os.path.exists(part_name):
+        os.remove(part_name) #Left over from a run that was killed.
+    tmark.tm('Starting Streamed Absolute Magnitude Calculations')
+    with fits.StreamingHDU(part_name,hdr_out) as shdu, spl.open_pool(workers) as pool:
+        for i in range(0,num_rec,chunk_size):
+            rows = np.array(raw_in[i:i+chunk_size]) #Only this chunk is read from disk.
+            recs = rows.view(in_dtype)[:,0]
+            magarr = ckpt_chunk(ckpt_dir,i,mags_part,recs['Z'],recs['PSFMAG'],recs['EXTINCTION'],
+                                bands=bands,norml=norml,cosmo=cosmo,workers=workers,pool=pool,
+                                kc_fallback=kc_fallback)
+            if sidecar == True:
+                out_rows = np.empty(len(rows),dtype=side_dtype)
+                for cname in side_dtype.names[:-1]:
+                    out_rows[cname] = recs[cname]
+                out_rows[mag_name] = magarr
+                shdu.write(out_rows.view('u1'))
+            else:
+                out_rows = np.empty((len(rows),row_len+mag_len),dtype='u1')
+                out_rows[:,:byte_adr] = rows[:,:byte_adr]
+                out_rows[:,byte_adr:byte_adr+mag_len] = magarr.astype('>f4').view('u1').reshape(-1,mag_len)
+                out_rows[:,byte_adr+mag_len:] = rows[:,byte_adr:]
+                shdu.write(out_rows.ravel())
+            pb.pbar(min(i+chunk_size,num_rec)-1,num_rec)
+    del raw_in
+    os.replace(part_name,out_name)
+    if ckpt_dir is not None:
+        ckpt_clear(ckpt_dir)
+    print('\nFile Written out as: {}'.format(out_name))
+    return out_name
+
+#Binned 1/Vmax luminosity function (Schmidt 1968). z_arr and absmag are the
+#redshift and absolute i-band magnitude columns, mag_lim is the survey apparent
+#magnitude limit. For each object the largest redshift it could have and still
+#be brighter than mag_lim is found from the inverse luminosity distance (no
+#per-object integration), using the same k-correction as calc_mags. Vmax is the
+#comoving volume of its redshift bin out to that redshift. z_bins and m_bins are
+#bin edges. Returns phi and its error (Mpc^-3 mag^-1) and the number of objects,
+#each shaped (number of z bins, number of M bins).
+def vmax_lf(z_arr,absmag,mag_lim,z_bins,m_bins,sky_frac=1.0,cosmo=None):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    z_arr = np.asarray(z_arr,dtype='f8')
+    absmag = np.asarray(absmag,dtype='f8')
+    z_bins,m_bins = np.asarray(z_bins,dtype='f8'),np.asarray(m_bins,dtype='f8')
+    num_z,num_m = len(z_bins) - 1,len(m_bins) - 1
+    #Only objects inside the bins with a real magnitude (0 and 999 are flags).
+    zb = np.searchsorted(z_bins,z_arr,side='right') - 1
+    mb = np.searchsorted(m_bins,absmag,side='right') - 1
+    wuse = ((zb >= 0) & (zb < num_z) & (mb >= 0) & (mb < num_m) & (absmag != 0) &
+            (absmag != 999) & np.isfinite(absmag))
+    zb,mb,z_use,m_use = zb[wuse],mb[wuse],z_arr[wuse],absmag[wuse]
+    #Distance modulus where the object hits the limit, then the redshift for it.
+    dm_max = mag_lim - m_use - k_corr(2.0)
+    z_max = cosmo.z_from_lum_dist(10.0**((dm_max - 25.0) / 5.0))
+    z_max = np.where(np.isnan(z_max),np.inf,np.maximum(z_max,z_use))
+    z_top = np.minimum(z_max,z_bins[zb+1])
+    vmax = cosmo.comove_vol_shell(z_bins[zb],z_top,sky_frac=sky_frac) * 1.0e9 #Mpc^3
+    #Sum 1/Vmax (and 1/Vmax^2 for the error) in each (z,M) bin.
+    bin_adr = zb * num_m + mb
+    dM = np.diff(m_bins)
+    phi = np.bincount(bin_adr,weights=1.0/vmax,minlength=num_z*num_m).reshape(num_z,num_m) / dM
+    phi_err = np.sqrt(np.bincount(bin_adr,weights=1.0/vmax**2,
+                                  minlength=num_z*num_m).reshape(num_z,num_m)) / dM
+    num_obj = np.bincount(bin_adr,minlength=num_z*num_m).reshape(num_z,num_m)
+    return phi,phi_err,num_obj
+
+#vmax_lf straight from a catalog file. area is the survey area in square degrees
+#(full sky if None). zcol and mcol are the redshift and absolute magnitude
+#columns (column names in FITS files are not case sensitive, so M_I finds m_i).
+def get_lf(ifile,mag_lim,z_bins,m_bins,area=None,zcol='Z',mcol='M_I'):
+    drfile = fits.open(ifile)[1].data
+    sky_frac = 1.0 if area is None else csm.sky_frac_area(area)
+    return vmax_lf(drfile[zcol],drfile[mcol],mag_lim,z_bins,m_bins,sky_frac=sky_frac)
 
-get_mags(sys.argv[1]) #Used so I can run this from command line.
+#Used so I can run this from command line:
+#  python abs_mag.py <file> [-o <output name>] [--sidecar] [--workers N] [--chunk N]
+#                     [--bands ugriz] [--kcorr-fallback powerlaw] [--checkpoint <dir>] [--resume]
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Absolute i-band magnitudes for a catalog.')
+    parser.add_argument('ifile',help='Input FITS catalog')
+    parser.add_argument('-o','--ofile',default=def_ofile,help='Output file name without .fits')
+    parser.add_argument('--sidecar',action='store_true',
+                        help='Write only PLATE/MJD/FIBERID and m_i to a small sidecar file')
+    parser.add_argument('--workers',type=int,default=1,help='Number of worker processes')
+    parser.add_argument('--chunk',type=int,default=None,help='Stream the catalog in chunks of this many rows')
+    parser.add_argument('--norml',action='store_true',help='Normalize all records to z=2')
+    parser.add_argument('--bands',default='i',help='Bands to calculate, e.g. ugriz')
+    parser.add_argument('--kcorr-fallback',default=None,choices=['powerlaw'],
+                        help='Use the power law k-correction for bands without a table')
+    parser.add_argument('--checkpoint',default=None,
+                        help='Save finished chunks to this folder (default <ofile>_ckpt with --resume)')
+    parser.add_argument('--resume',action='store_true',help='Skip chunks already in the checkpoint')
+    args = parser.parse_args()
+    get_mags(args.ifile,norml=args.norml,chunk_size=args.chunk,workers=args.workers,
+             ofile=args.ofile,sidecar=args.sidecar,bands=args.bands,ckpt_dir=args.checkpoint,
+             resume=args.resume,kc_fallback=args.kcorr_fallback)
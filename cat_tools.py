@@ -4,33 +4,27 @@ from pydl.pydlutils.sdss import sdss_flagname
 from pydl.pydlutils.sdss import sdss_flagval
 import tmark
 import progressBar as pb
+import fast_match as fm
 import glob
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 from sciCon import mks
 
 #Makes either a PMF hash array or a PM hash array. Parameter include_fiber
-#controls this. Returns a 1-D array of strings.
+#controls this (and include_mjd for PF). Returns a 1-D array of strings. These
+#are made from the integer keys (see mk_key), which are what to use for matching.
 def mk_hash(inrec,include_fiber=True,include_mjd=True,mname='MJD',fibname='FIBERID'):
     tmark.tm('Creating Hash Array')
-    num_rec = len(inrec)
-    len_plate = 5
-    if ((include_fiber==True)&(include_mjd==True)):
-        str_size = len_plate + 11
-        rec_hsh = np.chararray(num_rec,itemsize=str_size,unicode=True)
-        rec_hsh = np.array(['%05d-%05d-%04d'%(pt,mt,ft) for pt,mt,ft in zip(
-                            inrec['PLATE'],inrec[mname],inrec[fibname])])
-    elif ((include_fiber==False)&(include_mjd==True)):
-        str_size = len_plate + 6
-        rec_hsh = np.chararray(num_rec,itemsize=str_size,unicode=True)
-        rec_hsh = np.array(['%05d-%05d'%(pt,mt) for pt,mt in zip(
-                            inrec['PLATE'],inrec[mname])])
-    elif ((include_fiber==True)&(include_mjd==False)):
-        str_size = len_plate + 5
-        rec_hsh = np.chararray(num_rec,itemsize=str_size,unicode=True)
-        rec_hsh = np.array(['%05d-%04d'%(pt,ft) for pt,ft in zip(
-                            inrec['PLATE'],inrec[fibname])])
-    return rec_hsh
+    rec_key = mk_key(inrec,include_fiber=include_fiber,include_mjd=include_mjd,
+                     mname=mname,fibname=fibname)
+    return fm.key_str(rec_key,include_fiber=include_fiber,include_mjd=include_mjd)
+
+#Integer version of mk_hash: one int64 per row instead of a 16 character string.
+#Sorts in the same order as mk_hash. Use fast_match.key_str to get the strings
+#back for printing.
+def mk_key(inrec,include_fiber=True,include_mjd=True,mname='MJD',fibname='FIBERID'):
+    return fm.mk_key(inrec,include_fiber=include_fiber,include_mjd=include_mjd,
+                     mname=mname,fibname=fibname)
 
 #This function is designed to load a FITS table into a numpy structured array,
 #preserving the column names and data types (case-wise).
@@ -132,9 +126,10 @@ def fet(in_rec,in_name,quiet=False):
 #This program is designed to find all of the matches in two different fits
 #flat files, finding the addresses where the objects in 1 match the objects in 2.
 #rec_match_srt only works well with hash arrays (they compare one array)
-#so you will need to use mk_hsh_arr first to make PMF hash arrays for each fits
+#so you will need to use mk_key (or mk_hash) first to make PMF keys for each fits
 #flat file.
 def rec_match_srt(rec1,rec2,verbose=True):
+    rec1,rec2 = np.asarray(rec1),np.asarray(rec2)
     rec1a = np.argsort(rec1)
     rec2a = np.argsort(rec2)
     if verbose==True:
@@ -150,12 +145,87 @@ def rec_match_srt(rec1,rec2,verbose=True):
 
     return rec1a[rec1_adr],rec2a[rec2_adr]
 
+#Sorted index of a catalog for fast lookups by PLATE/MJD/FIBERID (and PLATE/
+#FIBERID), plus THING_ID and SDSS_NAME if thing_id or sdss_name are True. Build
+#it once, then every lookup is a binary search (O(log N)) instead of a pass over
+#the whole catalog:
+#   cat_idx = ct.CatalogIndex(drfile,thing_id=True)
+#   w = cat_idx.find(7166,56602,22)
+#   ct.find_rec(cat_idx,7166,56602,22) and ct.flags(cat_idx,7166,22) work too.
+#Scalar lookups return all of the matching addresses, same as np.where. Array
+#lookups (batches) return one address per query, the first match in catalog
+#order, or -1 if there isn't one.
+class CatalogIndex:
+    def __init__(self,inrec,pname='PLATE',mname='MJD',fibname='FIBERID',thing_id=False,
+                 sdss_name=False,tname='THING_ID',nname='SDSS_NAME'):
+        self.cat = inrec
+        self.names = (pname,mname,fibname)
+        pmf_key = fm.mk_key(inrec,pname=pname,mname=mname,fibname=fibname)
+        pf_key = fm.mk_key(inrec,include_mjd=False,pname=pname,mname=mname,fibname=fibname)
+        self.index = {'pmf':self.sort_index(pmf_key),'pf':self.sort_index(pf_key)}
+        if thing_id == True:
+            self.index['thing'] = self.sort_index(np.asarray(inrec[tname],dtype='i8'))
+        if sdss_name == True:
+            self.index['name'] = self.sort_index(np.char.strip(np.asarray(inrec[nname]).astype('U')))
+
+    def __len__(self):
+        return len(self.cat)
+
+    #Sorted keys and the permutation that sorts them (stable, so repeats stay
+    #in catalog order).
+    def sort_index(self,keys):
+        srt = np.argsort(keys,kind='stable')
+        return keys[srt],srt
+
+    def lookup(self,kind,query):
+        keys,srt = self.index[kind]
+        lo = keys.searchsorted(query,side='left')
+        if np.ndim(query) == 0:
+            hi = keys.searchsorted(query,side='right')
+            return np.sort(srt[lo:hi])
+        wfound = lo < len(keys)
+        wfound[wfound] = keys[lo[wfound]] == query[wfound]
+        return np.where(wfound,srt[np.minimum(lo,len(keys)-1)],-1)
+
+    #Makes query keys the same way as the catalog keys. Rows with a value out of
+    #range for a key can't be in the catalog, so just those get a key that
+    #matches nothing (-1); the rest of a batch is looked up as usual.
+    def query_key(self,include_mjd,*cols):
+        scalar = np.ndim(cols[0]) == 0
+        cols = np.broadcast_arrays(*[np.atleast_1d(np.asarray(col,dtype='i8')) for col in cols])
+        wvalid = cols[0] >= 0
+        for fld,col in zip(fm.key_fields(include_mjd=include_mjd),cols[1:]):
+            wvalid &= (col >= 0) & (col < 10**fm.key_digits[fld])
+        names = self.names if include_mjd else (self.names[0],self.names[2])
+        qrec = dict(zip(names,[col[wvalid] for col in cols]))
+        qkey = np.full(cols[0].shape,-1,dtype='i8')
+        qkey[wvalid] = fm.mk_key(qrec,include_mjd=include_mjd,pname=self.names[0],
+                                 mname=self.names[1],fibname=self.names[2])
+        return qkey[0] if scalar else qkey
+
+    def find(self,plate,mjd,fiberid):
+        return self.lookup('pmf',self.query_key(True,plate,mjd,fiberid))
+
+    def find_pf(self,plate,fiberid):
+        return self.lookup('pf',self.query_key(False,plate,fiberid))
+
+    def find_thing(self,thing_id):
+        return self.lookup('thing',np.asarray(thing_id,dtype='i8'))
+
+    def find_name(self,sdss_name):
+        return self.lookup('name',np.char.strip(np.asarray(sdss_name).astype('U')))
+
 #This program finds the object that you want in the file, then tells you all of
-#the targeting flags that object has, by name.
+#the targeting flags that object has, by name. infile can be a CatalogIndex to
+#skip the search through the whole file.
 def flags(infile,plate_in,fiber_in):
     pt = plate_in
     ft = fiber_in
-    w1 = np.where((infile['PLATE']==pt)&(infile['FIBERID']==ft))[0]
+    if isinstance(infile,CatalogIndex):
+        w1 = infile.find_pf(pt,ft)
+        infile = infile.cat
+    else:
+        w1 = np.where((infile['PLATE']==pt)&(infile['FIBERID']==ft))[0]
     unstr = '--UNUSED--'
 
     try:
@@ -223,7 +293,11 @@ def rec_view(inrec,rec_adr=0):
 
 #This is for getting the index for a record matching a plate,mjd,fiber.
 #I use this functionality enough, I was tired of typing the where command.
+#If inrec is a CatalogIndex, it uses the index instead (and plate, mjd, and
+#fiberid can be arrays for a batch, see CatalogIndex).
 def find_rec(inrec,plate,mjd,fiberid,pname='PLATE',mname='MJD',fibname='FIBERID'):
+    if isinstance(inrec,CatalogIndex):
+        return inrec.find(plate,mjd,fiberid)
     pt,mt,ft = plate,mjd,fiberid
     wpmf = np.where((inrec[pname]==pt)&(inrec[mname]==mt)&(inrec[fibname]==ft))[0]
     return wpmf
@@ -271,7 +345,49 @@ def lzdiff(lam1,lamt,p=0):
     else:
         return ld
 
+#Matches two catalogs on PLATE/MJD/FIBERID. Returns the addresses in each that
+#match. cat1 and cat2 can be catalogs, or PMF key arrays already made with mk_key
+#(or string hash arrays from mk_hash) to skip making them again. They can also
+#be FITS file names, which use (and make, the first time) the file's saved PMF
+#index (see fast_match.pmf_index), so there is no hashing or sorting at all.
 def cat_set(cat1,cat2):
-    cathash1,cathash2 = mk_hash(cat1),mk_hash(cat2)
-    cat1args,cat2args = rec_match_srt(cathash1,cathash2)
+    catkey1,catsrt1 = cat_sorted(cat1)
+    catkey2,catsrt2 = cat_sorted(cat2)
+    cat1args,cat2args = fm.rec_match_sorted(catkey1,catsrt1,catkey2,catsrt2)
     return cat1args,cat2args
+
+#Pairs version of cat_set: aligned addresses for every match, with inner, left,
+#or outer join rules and optional multiplicities (see fast_match.rec_join). The
+#join engine is picked by fast_match.rec_match_auto unless engine is given.
+#File names use their saved PMF indexes and the sort-merge join, like cat_set.
+def cat_join(cat1,cat2,how='inner',unique=False,counts=False,engine='auto'):
+    if isinstance(cat1,str) | isinstance(cat2,str):
+        catkey1,catsrt1 = cat_sorted(cat1)
+        catkey2,catsrt2 = cat_sorted(cat2)
+        fm.last_engine = 'merge'
+        return fm.rec_join_sorted(catkey1,catsrt1,catkey2,catsrt2,how=how,unique=unique,
+                                  counts=counts)
+    return fm.rec_match_auto(cat_keys(cat1),cat_keys(cat2),how=how,unique=unique,
+                             counts=counts,engine=engine)
+
+#Positional match of two catalogs by their RA/DEC columns (degrees) within radius
+#arcsec. Returns addresses in each and the separations in arcsec, the closest
+#match per cat1 object if nearest, or every pair (see fast_match.sky_match).
+def cat_sky_match(cat1,cat2,radius,nearest=True,raname='RA',decname='DEC'):
+    return fm.sky_match(cat1[raname],cat1[decname],cat2[raname],cat2[decname],radius,
+                        nearest=nearest)
+
+#PMF keys for a catalog. An array that is already a key array is passed through.
+def cat_keys(cat):
+    if np.asarray(cat).dtype.names is None:
+        return np.asarray(cat)
+    return mk_key(cat)
+
+#Sorted PMF keys and the sort permutation for a catalog, key array, or FITS file
+#name (from its saved index).
+def cat_sorted(cat):
+    if isinstance(cat,str):
+        return fm.pmf_index(cat)
+    catkey = cat_keys(cat)
+    catsrt = np.argsort(catkey,kind='stable')
+    return catkey[catsrt],catsrt
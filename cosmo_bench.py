@@ -0,0 +1,216 @@
+"""
+Benchmark and accuracy check for the distance and lookback time integrators in
+abs_mag and cosmo_calc. Every integrator is run over a grid of redshifts and
+the wall time, number of f(z) evaluations, and relative error against a high
+precision reference (scipy's QUADPACK quad at rtol=1e-13, independent of the
+integrators being tested) are recorded. The vectorized engines are also timed
+on a large array of redshifts (best of a few repeats) and their throughput
+recorded, since a single call is too quick to time. The results are written to
+a JSON file so runs from different versions can be compared to catch slowdowns
+or lost accuracy.
+
+use from the command line via
+python cosmo_bench.py [-o results.json] [--compare old_results.json] [--quick]
+
+Parameters
+----------
+ofile : :class:'str'
+	OPTIONAL - the JSON file to write. Defaults to cosmo_bench.json.
+compare : :class:'str'
+	OPTIONAL - an earlier results file. Any integrator that got more than
+    time_tol times slower (and at least time_floor seconds slower) or err_tol
+    times less accurate is reported.
+quick : :class:'boolean'
+	OPTIONAL - skip the slow pure Python loops (the old Simpson's/trapezoid/
+    Reimann sums), for a fast check of the vectorized engines only.
+
+Returns
+----------
+:class:'dict'
+	The results, also written to ofile.
+"""
+import numpy as np
+import argparse
+import json
+import platform
+import time
+import scipy.integrate as sint
+import abs_mag as am
+import cosmo_calc as csm
+
+#Redshifts to test at. Covers nearby, the quasar range, and recombination.
+z_grid = [0.01,0.1,0.5,1.0,2.355,5.0,7.0,1089.0]
+ref_rtol = 1.0e-13
+time_tol = 1.5 #Flag anything that takes 1.5 times as long as before.
+err_tol = 10.0 #Flag anything with 10 times the error it had before.
+time_floor = 1.0e-3 #Timing changes smaller than this (seconds) are just noise.
+n_arr = 1000000 #Redshifts in the array timing.
+n_rep = 3 #Array timings are the best of this many runs.
+
+#Wraps a module's z_func so every f(z) evaluation is counted. Array arguments
+#count one evaluation per element.
+class EvalCounter:
+    def __init__(self,module):
+        self.module = module
+        self.func = module.z_func
+        self.count = 0
+
+    def __call__(self,z_t):
+        self.count += np.size(z_t)
+        return self.func(z_t)
+
+    def __enter__(self):
+        self.module.z_func = self
+        return self
+
+    def __exit__(self,*args):
+        self.module.z_func = self.func
+
+#Times one call of func(z) and counts the f(z) calls it made in module.
+#Fresh Cosmology objects are used for the table and adaptive methods so nothing
+#is remembered from an earlier call (the table build is timed separately).
+def run_one(func,z,module):
+    with EvalCounter(module) as cnt:
+        t0 = time.perf_counter()
+        val = func(z)
+        t1 = time.perf_counter()
+    if isinstance(val,tuple):
+        val = val[0]
+    return float(val),t1 - t0,cnt.count
+
+#Times func on an array of redshifts, best of n_rep runs like timeit, so the
+#time is well above time_floor and the noise of a single run.
+def run_array(func,z_arr):
+    best = np.inf
+    for i in range(n_rep):
+        t0 = time.perf_counter()
+        func(z_arr)
+        best = min(best,time.perf_counter() - t0)
+    return best
+
+#Each entry: name, function of z, the module whose z_func it uses, the kind of
+#quantity (for the reference), whether it is a slow pure Python loop, and
+#whether it takes an array of redshifts (so gets the array timing).
+#The Cosmology based methods call Cosmology.z_func rather than the module
+#z_func, so those evaluations are counted with CosmoCounter as well.
+def method_list():
+    return [
+        ('abs_mag.prop_dist_reim',am.prop_dist_reim,am,'dc',True,False),
+        ('abs_mag.prop_dist_trap',am.prop_dist_trap,am,'dc',True,False),
+        ('abs_mag.prop_dist_simp',am.prop_dist_simp,am,'dc',True,False),
+        ('abs_mag.prop_dist_arr',am.prop_dist_arr,am,'dc',False,True),
+        ('cosmo_calc.comove_dist',csm.comove_dist,csm,'dc',True,False),
+        ('cosmo_calc.comove_dist_arr',csm.comove_dist_arr,csm,'dc',False,True),
+        ('cosmo_calc.comove_dist_tab',csm.comove_dist_tab,csm,'dc',False,True),
+        ('cosmo_calc.comove_dist_adapt',lambda z: csm.Cosmology().comove_dist_adapt(z),csm,'dc',False,False),
+        ('cosmo_calc.lookback_time',lambda z: csm.lookback_time(0,z),csm,'lb',True,False),
+        ('cosmo_calc.lookback_time_tab',lambda z: csm.lookback_time_tab(0,z),csm,'lb',False,True),
+        ('cosmo_calc.lookback_time_adapt',lambda z: csm.Cosmology().lookback_time_adapt(0,z),csm,'lb',False,False),
+    ]
+
+#The Cosmology methods call self.z_func, so count those by swapping the method
+#on the class for the length of the benchmark.
+class CosmoCounter(EvalCounter):
+    def __init__(self):
+        self.module = csm.Cosmology
+        self.func = csm.Cosmology.z_func
+        self.count = 0
+
+    def __call__(self,cosmo,z_t):
+        self.count += np.size(z_t)
+        return self.func(cosmo,z_t)
+
+    def __enter__(self):
+        counter = self
+        self.module.z_func = lambda cosmo,z_t: counter(cosmo,z_t)
+        return self
+
+#The reference values come from scipy's adaptive quad rather than the Gauss-
+#Kronrod code in cosmo_calc, so the adapt methods aren't checked against
+#themselves. Integrated in u = ln(1+z) to smooth out the high redshift tail.
+def reference(kind,z):
+    ref_cosmo = csm.Cosmology(csm.h0,csm.omegaM,csm.omegaR,csm.omegaL)
+    kern = ref_cosmo.z_func if kind == 'dc' else ref_cosmo.lb_func
+    u_func = lambda u: kern(np.expm1(u)) * np.exp(u)
+    val = sint.quad(u_func,0.0,np.log1p(z),epsabs=0.0,epsrel=ref_rtol,limit=500)[0]
+    return val if kind == 'dc' else val * csm.gyr_conv
+
+def run_bench(quick=False):
+    res = {'meta':{'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python':platform.python_version(),'numpy':np.__version__,
+                   'machine':platform.machine(),'z_grid':z_grid,
+                   'n_arr':n_arr,'n_rep':n_rep,
+                   'params':[csm.h0,csm.omegaM,csm.omegaR,csm.omegaL]},
+           'methods':{},'array':{}}
+    #Time building the distance table on its own (nothing cached).
+    csm.tab_cache.clear()
+    t0 = time.perf_counter()
+    tab = csm.Cosmology().make_table()
+    res['meta']['table_build_s'] = time.perf_counter() - t0
+    res['meta']['table_rtol'] = float(tab['rtol'])
+    csm.get_cosmo().table() #Load (or build) it so table lookups are timed alone.
+
+    refs = {(kind,z):reference(kind,z) for kind in ['dc','lb'] for z in z_grid}
+    z_arr = np.linspace(0.0,z_grid[-3],n_arr) #Up to z=7, the quasar range.
+    for name,func,module,kind,slow,vec in method_list():
+        if slow & quick:
+            continue
+        rows = []
+        for z in z_grid:
+            with CosmoCounter() as ccnt:
+                val,wall,neval = run_one(func,z,module)
+            neval += ccnt.count
+            ref = refs[(kind,z)]
+            rows.append({'z':z,'value':val,'ref':ref,'rel_err':abs(val / ref - 1.0),
+                         'time_s':wall,'neval':int(neval)})
+        res['methods'][name] = rows
+        worst = max([r['rel_err'] for r in rows])
+        tot = sum([r['time_s'] for r in rows])
+        print('{:34} | time: {:9.4f} s | worst rel err: {:9.2e}'.format(name,tot,worst))
+        if vec:
+            wall = run_array(func,z_arr)
+            res['array'][name] = {'time_s':wall,'z_per_s':n_arr / wall}
+            print('{:34} | array: {:8.4f} s | {:9.3e} z/s'.format('',wall,n_arr / wall))
+    return res
+
+#Compares two result dictionaries and returns a list of regressions.
+def compare(res,old):
+    regs = []
+    for name,rows in res['methods'].items():
+        if name not in old['methods']:
+            continue
+        old_rows = {r['z']:r for r in old['methods'][name]}
+        for r in rows:
+            o = old_rows.get(r['z'])
+            if o is None:
+                continue
+            if (r['time_s'] > time_tol * o['time_s']) & (r['time_s'] - o['time_s'] > time_floor):
+                regs.append('{} z={}: time {:.3g} s -> {:.3g} s'.format(name,r['z'],o['time_s'],r['time_s']))
+            if r['rel_err'] > err_tol * max(o['rel_err'],1.0e-15):
+                regs.append('{} z={}: rel err {:.3g} -> {:.3g}'.format(name,r['z'],o['rel_err'],r['rel_err']))
+    #Array timings, only comparable if the array was the same size.
+    if old['meta'].get('n_arr') == res['meta']['n_arr']:
+        for name,r in res['array'].items():
+            o = old.get('array',{}).get(name)
+            if o is None:
+                continue
+            if (r['time_s'] > time_tol * o['time_s']) & (r['time_s'] - o['time_s'] > time_floor):
+                regs.append('{} array: time {:.3g} s -> {:.3g} s'.format(name,o['time_s'],r['time_s']))
+    return regs
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cosmology integrators.')
+    parser.add_argument('-o','--ofile',default='cosmo_bench.json',help='Output JSON file')
+    parser.add_argument('--compare',default=None,help='Earlier results to compare against')
+    parser.add_argument('--quick',action='store_true',help='Skip the slow pure Python loops')
+    args = parser.parse_args()
+    res = run_bench(quick=args.quick)
+    with open(args.ofile,'w') as jf:
+        json.dump(res,jf,indent=1)
+    print('\nResults written to: {}'.format(args.ofile))
+    if args.compare is not None:
+        with open(args.compare) as jf:
+            regs = compare(res,json.load(jf))
+        print('\n{} regressions against {}'.format(len(regs),args.compare))
+        for reg in regs:
+            print(reg)
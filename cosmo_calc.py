@@ -29,9 +29,24 @@ Returns
 --mag_test--
 :class:'float'
     Returns the absolute i-band magnitude of the object.
+
+--dist_arr--
+:class:'tuple'
+    Comoving, luminosity, and angular size distances (Mpc) for an array of
+    redshifts, calculated in one vectorized pass.
+
+--query--
+:class:'dict'
+    The report columns for one JSON style request. Also answered by the query
+    server: python cosmo_calc.py --serve [socket path]
 """
 import numpy as np
 import sys
+import os
+import io
+import json
+import warnings
+import shared_pool as spl
 
 #USES FLAT COSMOLOGY WITH COSMOLOGICAL CONSTANT: BENCHMARK MODEL
 #Define a number of used constants, taken 20180314 from Ned Wright's page.
@@ -43,6 +58,10 @@ omegaM = 0.286 #Matter density parameter
 omegaR = 9.0e-5 #Taken from Barbara Ryden's Introduction to Cosmology, 2ed.
 omegaL = 1.0 - omegaR - omegaM #Vacuum density parameter defined using omegaR
 c = 299792.458 #speed of light in km/s
+#Dark energy equation of state w(a) = w0 + wa*(1-a). Only used by Cosmology (and
+#so by get_cosmo), the module level z_func is always the cosmological constant.
+w0 = -1.0
+wa = 0.0
 
 #Calculates the f(z) for finding proper distance using integral form.
 def z_func(z_t):
@@ -106,6 +125,470 @@ def lookback_time(z_l,z_p):
     lT = lT * 978.3386176 / c #Corrects for h0
     return lT #Returns the lookback time in Gyr.
 
+#The integrand for lookback time, f(z)/(1+z). Multiply the integral by gyr_conv
+#to get Gyr.
+def lb_func(z_t):
+    return z_func(z_t) / (1.0 + z_t)
+
+gyr_conv = 978.3386176 / c
+
+#Gauss-Legendre nodes and weights used by the vectorized distance engine. The
+#integral is done in u = ln(1+z) instead of z. The integrand is smooth in u all
+#the way out to z = 1089, so 48 nodes beats the 100,000 step Simpson's method.
+gl_order = 48
+gl_nodes,gl_weights = np.polynomial.legendre.leggauss(gl_order)
+
+#Vectorized integral of kern(z) dz from z_lo to z_hi. Both may be arrays (or
+#one a scalar). Works in chunks of objects so a few million redshifts never
+#make a (num_obj x gl_order) array bigger than ~25 MB.
+def gl_integral(kern,z_lo,z_hi,chunk=65536):
+    z_lo,z_hi = np.broadcast_arrays(np.asarray(z_lo,dtype='f8'),
+                                    np.asarray(z_hi,dtype='f8'))
+    shp = z_lo.shape
+    u_lo,u_hi = np.log1p(z_lo.ravel()),np.log1p(z_hi.ravel())
+    out_arr = np.zeros(len(u_lo),dtype='f8')
+    for i in range(0,len(u_lo),chunk):
+        ua,ub = u_lo[i:i+chunk,None],u_hi[i:i+chunk,None]
+        half = 0.5 * (ub - ua) #Half-width of each interval in u.
+        u_n = ua + half * (gl_nodes + 1.0) #Node locations for every object.
+        z_n = np.expm1(u_n)
+        #dz = (1+z) du, so the integrand in u picks up a (1+z) factor.
+        out_arr[i:i+chunk] = half[:,0] * np.dot(kern(z_n) * (1.0 + z_n),gl_weights)
+    return out_arr.reshape(shp)
+
+#Gauss-Kronrod (7 point Gauss, 15 point Kronrod) nodes and weights. The nodes
+#are the positive half only, the rule is symmetric.
+gk_xk = np.array([0.991455371120812639206854697526329,0.949107912342758524526189684047851,
+                  0.864864423359769072789712788640926,0.741531185599394439863864773280788,
+                  0.586087235467691130294144845693013,0.405845151377397166906606412076961,
+                  0.207784955007898467600689403773245,0.000000000000000000000000000000000])
+gk_wk = np.array([0.022935322010529224963732008058970,0.063092092629978553290700663189204,
+                  0.104790010322250183839876322541518,0.140653259715525918745189590510238,
+                  0.169004726639267902826583426598550,0.190350578064785409913256402421014,
+                  0.204432940075298892414161999234649,0.209482141084727828012999174891714])
+gk_wg = np.array([0.129484966168869693270611432679082,0.279705391489276667901467771423780,
+                  0.381830050505118944950369775488975,0.417959183673469387755102040816327])
+
+#One 15 point Kronrod panel on [a,b]. Returns the Kronrod estimate and the
+#difference from the embedded 7 point Gauss estimate as the error.
+def gk_panel(func,a,b):
+    half = 0.5 * (b - a)
+    mid = 0.5 * (b + a)
+    x_n = np.concatenate((mid - half * gk_xk[:-1],[mid],mid + half * gk_xk[-2::-1]))
+    f_n = func(x_n)
+    w_k = np.concatenate((gk_wk[:-1],gk_wk[-1:],gk_wk[-2::-1]))
+    w_g = np.zeros(15)
+    w_g[1:7:2] = gk_wg[:3]
+    w_g[7] = gk_wg[3]
+    w_g[9:15:2] = gk_wg[2::-1]
+    res_k = half * np.dot(w_k,f_n)
+    res_g = half * np.dot(w_g,f_n)
+    return res_k,abs(res_k - res_g)
+
+#Adaptive Gauss-Kronrod integration of func from a to b. Keeps splitting the
+#panel with the largest error until the summed error is below rtol (relative)
+#or atol (absolute). Returns the integral, the error estimate it reached, and
+#the number of function evaluations it took.
+def gk_quad(func,a,b,rtol=1.0e-8,atol=0.0,max_panels=500):
+    res,err = gk_panel(func,a,b)
+    panels = [(err,a,b,res)]
+    tot_res,tot_err = res,err
+    neval = 15
+    while (tot_err > max(atol,rtol * abs(tot_res))) & (len(panels) < max_panels):
+        #Split the worst panel in half.
+        wmax = int(np.argmax([p[0] for p in panels]))
+        p_err,pa,pb,p_res = panels.pop(wmax)
+        pm = 0.5 * (pa + pb)
+        res1,err1 = gk_panel(func,pa,pm)
+        res2,err2 = gk_panel(func,pm,pb)
+        neval += 30
+        panels += [(err1,pa,pm,res1),(err2,pm,pb,res2)]
+        tot_res = sum([p[3] for p in panels])
+        tot_err = sum([p[0] for p in panels])
+    return tot_res,tot_err,neval
+
+#Integrates kern(z) dz from z_l to z_p adaptively in u = ln(1+z).
+def adapt_integral(kern,z_l,z_p,rtol=1.0e-8):
+    u_func = lambda u: kern(np.expm1(u)) * np.exp(u)
+    return gk_quad(u_func,np.log1p(z_l),np.log1p(z_p),rtol=rtol)
+
+#The cumulative distance table. Integrates once from z=0 to tab_zmax on a grid
+#uniform in u = ln(1+z), then every later query is a cubic Hermite interpolation
+#using the exact derivatives (the integrands themselves). The table is checked
+#at every interval midpoint against direct integration when it is built, and
+#the grid is doubled until the worst relative error is below tab_rtol (with a
+#warning if that takes more than tab_maxpts points). A cosmology with no real
+#distances out to tab_zmax (h0 <= 0, or H(z)^2 <= 0 somewhere) raises a
+#ValueError instead of building a table.
+#Tables are saved next to k_corr_tab.dat, keyed by the cosmological parameters,
+#so later processes just load them. Tables are also shared in memory between
+#Cosmology objects with the same parameters.
+tab_zmax = 1100.0
+tab_npts = 2049
+tab_rtol = 1.0e-9
+tab_maxpts = 2**20
+tab_dir = os.path.dirname(os.path.abspath(__file__))
+tab_cache = {} #Tables already built or loaded in this process.
+
+def tab_name(key):
+    kstr = '_'.join(['{:.10g}'.format(k) for k in key])
+    return os.path.join(tab_dir,'cosmo_tab_{}.npz'.format(kstr))
+
+#A set of cosmological parameters plus everything calculated from them. Each
+#object carries its own h0/omegaM/omegaR/omegaL, so different parameter sets can
+#be used side by side in one program:
+#   dr14 = csm.Cosmology(67.8,0.308,9.0e-5)
+#   dr14.comove_dist(zarr)
+#If omegaL isn't given, it is set to make the universe flat. Giving omegaL makes
+#the curvature omegaK = 1 - omegaM - omegaR - omegaL, so open and closed models
+#work too. w0 and wa are the dark energy equation of state w(a) = w0 + wa*(1-a)
+#(w0=-1, wa=0 is the cosmological constant):
+#   wcdm = csm.Cosmology(70.0,0.3,9.0e-5,0.65,w0=-0.9,wa=0.1)
+#All of them use the same tables and vectorized integrals as the default model.
+class Cosmology:
+    def __init__(self,h0=69.6,omegaM=0.286,omegaR=9.0e-5,omegaL=None,name='',
+                 w0=-1.0,wa=0.0):
+        self.h0 = float(h0)
+        self.omegaM = float(omegaM)
+        self.omegaR = float(omegaR)
+        if omegaL is None:
+            omegaL = 1.0 - omegaR - omegaM
+        self.omegaL = float(omegaL)
+        self.omegaK = 1.0 - self.omegaM - self.omegaR - self.omegaL
+        if abs(self.omegaK) < 1.0e-12: #Just round off, call it flat.
+            self.omegaK = 0.0
+        self.w0 = float(w0)
+        self.wa = float(wa)
+        self.name = name
+        self.memo = {} #Scalar results already calculated with these parameters.
+
+    def __repr__(self):
+        extra = ''
+        if self.omegaK != 0.0:
+            extra += ', Wk={:0.5f}'.format(self.omegaK)
+        if (self.w0 != -1.0) | (self.wa != 0.0):
+            extra += ', w0={}, wa={}'.format(self.w0,self.wa)
+        return 'Cosmology({}H0={}, Wm={}, Wr={}, Wl={:0.5f}{})'.format(
+                '{}: '.format(self.name) if self.name else '',
+                self.h0,self.omegaM,self.omegaR,self.omegaL,extra)
+
+    #The parameters that define this cosmology. Used for the table cache.
+    def key(self):
+        return (self.h0,self.omegaM,self.omegaR,self.omegaL,self.w0,self.wa)
+
+    #The f(z) for comoving distance, c/H(z). For flat LCDM this is the same as
+    #the module level z_func. The curvature and dark energy terms are only
+    #added when they are used.
+    def z_func(self,z_t):
+        b1 = self.omegaR * (1 + z_t)**4 #Radiation term
+        b2 = self.omegaM * (1 + z_t)**3 #Matter term
+        b3 = self.omegaL              #Cosmological Constant (vac) term
+        if (self.w0 != -1.0) | (self.wa != 0.0):
+            #Dark energy density for w(a) = w0 + wa*(1-a) (Chevallier-Polarski-Linder).
+            b3 = b3 * (1 + z_t)**(3*(1 + self.w0 + self.wa)) * np.exp(-3*self.wa*z_t/(1 + z_t))
+        if self.omegaK != 0.0:
+            b3 = b3 + self.omegaK * (1 + z_t)**2 #Curvature term
+        return c / (self.h0 * (b1 + b2 + b3)**(0.5))
+
+    #The integrand for lookback time, f(z)/(1+z).
+    def lb_func(self,z_t):
+        return self.z_func(z_t) / (1.0 + z_t)
+
+    #Integrate both kernels over each interval of the u-grid and cumulatively sum.
+    def make_table(self,npts=tab_npts):
+        if not self.h0 > 0: #Also catches nan.
+            raise ValueError('h0 must be positive, not {}'.format(self.h0))
+        while True:
+            u_grid = np.linspace(0.0,np.log1p(tab_zmax),npts)
+            z_grid = np.expm1(u_grid)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                d_grid = np.concatenate(([0.0],np.cumsum(gl_integral(self.z_func,z_grid[:-1],z_grid[1:]))))
+                t_grid = np.concatenate(([0.0],np.cumsum(gl_integral(self.lb_func,z_grid[:-1],z_grid[1:]))))
+            if not (np.all(np.isfinite(d_grid)) & np.all(np.isfinite(t_grid))):
+                raise ValueError('{} has no real distances out to z={} (H(z)^2 <= 0 '
+                                 'somewhere)'.format(self,tab_zmax))
+            tab = {'u':u_grid,'z':z_grid,'dc':d_grid,'lb':t_grid}
+            #Check the interpolation at the midpoints, where it is worst.
+            z_mid = np.expm1(0.5 * (u_grid[1:] + u_grid[:-1]))
+            d_mid = d_grid[:-1] + gl_integral(self.z_func,z_grid[:-1],z_mid)
+            d_err = np.abs(self.tab_interp('dc',z_mid,tab=tab) / d_mid - 1.0)
+            tab['rtol'] = np.amax(d_err)
+            if tab['rtol'] <= tab_rtol:
+                return tab
+            if npts > tab_maxpts:
+                warnings.warn('Distance table for {} only reached rtol={:.3g}, not tab_rtol={:.3g}'
+                              .format(self,tab['rtol'],tab_rtol),stacklevel=2)
+                return tab
+            npts = 2 * npts - 1
+
+    #Returns the table for this cosmology. Checks memory first, then disk, and
+    #only builds (and saves) a new one if neither has it.
+    def table(self):
+        key = self.key()
+        if key in tab_cache:
+            return tab_cache[key]
+        tname = tab_name(key)
+        tab = None
+        if os.path.exists(tname):
+            try:
+                with np.load(tname) as tf:
+                    if tuple(tf['key']) == key:
+                        tab = {k:tf[k] for k in ['u','z','dc','lb','rtol']}
+                if not np.all(np.isfinite(tab['dc'])) & np.all(np.isfinite(tab['lb'])):
+                    tab = None #A bad table from an older version, build it again.
+            except (OSError,KeyError,ValueError):
+                tab = None
+        if tab is None:
+            tab = self.make_table()
+            #Write to a temporary name and rename, so a half-written table is
+            #never picked up by another process. If the folder isn't writable,
+            #just skip it.
+            try:
+                tmp_name = '{}.{}.tmp.npz'.format(tname[:-4],os.getpid())
+                np.savez(tmp_name,key=np.array(key),**tab)
+                os.replace(tmp_name,tname)
+            except OSError:
+                pass
+        tab_cache[key] = tab
+        return tab
+
+    #Cubic Hermite interpolation of table column col ('dc' or 'lb') at z_arr.
+    #Redshifts past tab_zmax are integrated directly instead.
+    def tab_interp(self,col,z_arr,tab=None):
+        if tab is None:
+            tab = self.table()
+        z_arr = np.asarray(z_arr,dtype='f8')
+        shp = z_arr.shape
+        z_arr = z_arr.ravel()
+        kern = self.z_func if col == 'dc' else self.lb_func
+        u_grid,y_grid = tab['u'],tab[col]
+        du = u_grid[1] - u_grid[0]
+        u_arr = np.log1p(z_arr)
+        #nan redshifts get index 0 here, but stay nan in the output.
+        idx = np.clip(np.nan_to_num((u_arr - u_grid[0]) / du).astype('i8'),0,len(u_grid)-2)
+        s = (u_arr - u_grid[idx]) / du
+        #Derivatives in u: dy/du = kern(z) * (1+z)
+        za,zb = tab['z'][idx],tab['z'][idx+1]
+        ma,mb = kern(za) * (1.0 + za) * du,kern(zb) * (1.0 + zb) * du
+        s2,s3 = s * s,s * s * s
+        out_arr = ((2*s3 - 3*s2 + 1) * y_grid[idx] + (s3 - 2*s2 + s) * ma +
+                   (-2*s3 + 3*s2) * y_grid[idx+1] + (s3 - s2) * mb)
+        wout = z_arr > tab['z'][-1]
+        if np.any(wout):
+            out_arr[wout] = y_grid[-1] + gl_integral(kern,tab['z'][-1],z_arr[wout])
+        return out_arr.reshape(shp)
+
+    #Comoving distance (Mpc) for a scalar or array of redshifts. The default
+    #uses the table, quad=True integrates every redshift directly instead.
+    def comove_dist(self,z_arr,quad=False):
+        if quad == True:
+            return gl_integral(self.z_func,0.0,z_arr)
+        return self.tab_interp('dc',z_arr)
+
+    #Transverse comoving distance (Mpc) from the line of sight comoving distance.
+    #The same thing in a flat universe, sinh/sin of it for open/closed ones.
+    def trans_dist(self,dc):
+        if self.omegaK == 0.0:
+            return dc
+        dh = c / self.h0 #Hubble distance
+        sk = np.sqrt(abs(self.omegaK))
+        if self.omegaK > 0:
+            return dh / sk * np.sinh(sk * dc / dh)
+        return dh / sk * np.sin(sk * dc / dh)
+
+    #Comoving, luminosity, and angular size distances (Mpc) in one pass.
+    def dist(self,z_arr,quad=False):
+        z_arr = np.asarray(z_arr,dtype='f8')
+        dc = self.comove_dist(z_arr,quad=quad)
+        dm = self.trans_dist(dc)
+        return dc,lum_dist(dm,z_arr),ang_dist(dm,z_arr)
+
+    #Luminosity distance (Mpc) for a scalar or array of redshifts.
+    def lum_dist(self,z_arr,quad=False):
+        z_arr = np.asarray(z_arr,dtype='f8')
+        return lum_dist(self.trans_dist(self.comove_dist(z_arr,quad=quad)),z_arr)
+
+    #Full sky comoving volume (Gpc^3) inside transverse comoving distance dm.
+    #For curved universes this is Hogg (1999) eq. 29.
+    def vol_from_dist(self,dm):
+        if self.omegaK == 0.0:
+            return ((4.0/3) * np.pi * dm**(3.0))/(1.0e9)
+        dh = c / self.h0
+        sk = np.sqrt(abs(self.omegaK))
+        x = dm / dh
+        if self.omegaK > 0:
+            ang = np.arcsinh(sk * x) / sk
+        else:
+            ang = np.arcsin(sk * x) / sk
+        return ((2.0 * np.pi * dh**3 / self.omegaK) *
+                (x * np.sqrt(1.0 + self.omegaK * x**2) - ang))/(1.0e9)
+
+    #Full sky comoving volume out to z_arr in Gpc^3.
+    def comove_vol(self,z_arr):
+        return self.vol_from_dist(self.trans_dist(self.comove_dist(z_arr)))
+
+    #Comoving volume (Gpc^3) of the shells between z_lo and z_hi (scalars or
+    #arrays, like the edges of redshift bins) for a fraction sky_frac of the sky.
+    #Use sky_frac_area to turn a survey area into the fraction.
+    def comove_vol_shell(self,z_lo,z_hi,sky_frac=1.0):
+        return sky_frac * (self.comove_vol(z_hi) - self.comove_vol(z_lo))
+
+    #Lookback time (Gyr) between z_l and z_p (either can be arrays).
+    #Age of the universe at z is lookback_time(z,1089).
+    def lookback_time(self,z_l,z_p,quad=False):
+        if quad == True:
+            return gl_integral(self.lb_func,z_l,z_p) * gyr_conv
+        return (self.tab_interp('lb',z_p) - self.tab_interp('lb',z_l)) * gyr_conv
+
+    #Error controlled versions. These return (value, error estimate, function
+    #evaluations). Scalar results are remembered, so asking again is free.
+    def comove_dist_adapt(self,z_p,rtol=1.0e-8):
+        mkey = ('dc',float(z_p),rtol)
+        if mkey not in self.memo:
+            self.memo[mkey] = adapt_integral(self.z_func,0.0,z_p,rtol=rtol)
+        return self.memo[mkey]
+
+    def lookback_time_adapt(self,z_l,z_p,rtol=1.0e-8):
+        mkey = ('lb',float(z_l),float(z_p),rtol)
+        if mkey not in self.memo:
+            lT,lT_err,neval = adapt_integral(self.lb_func,z_l,z_p,rtol=rtol)
+            self.memo[mkey] = (lT * gyr_conv,lT_err * gyr_conv,neval)
+        return self.memo[mkey]
+
+    #Inverse of the table: redshift where column col reaches y_arr. col is 'dc'
+    #(comoving distance, Mpc), 'lb' (lookback time integral, in the table's units),
+    #or 'dl' (luminosity distance, Mpc). In a closed universe the luminosity
+    #distance can turn over at high z, then only the first branch is found
+    #reliably. The first guess comes from linear
+    #interpolation of the monotonic table, then a few vectorized Newton steps
+    #using the exact derivative polish it. Values off the table come back as nan.
+    def tab_invert(self,col,y_arr,niter=4):
+        tab = self.table()
+        y_arr = np.asarray(y_arr,dtype='f8')
+        shp = y_arr.shape
+        y_arr = y_arr.ravel()
+        if col == 'dl':
+            y_grid = self.trans_dist(tab['dc']) * (1.0 + tab['z'])
+        else:
+            y_grid = tab[col]
+        z_arr = np.expm1(np.interp(y_arr,y_grid,tab['u'],left=np.nan,right=np.nan))
+        for i in range(niter):
+            if col == 'dl':
+                dm = self.trans_dist(self.tab_interp('dc',z_arr,tab=tab))
+                resid = dm * (1.0 + z_arr) - y_arr
+                #d(dm)/d(dc) = sqrt(1 + omegaK (dm/dh)^2), which is 1 when flat.
+                ddm = np.sqrt(1.0 + self.omegaK * (dm * self.h0 / c)**2)
+                deriv = self.z_func(z_arr) * ddm * (1.0 + z_arr) + dm
+            else:
+                resid = self.tab_interp(col,z_arr,tab=tab) - y_arr
+                deriv = self.z_func(z_arr) if col == 'dc' else self.lb_func(z_arr)
+            z_arr = np.maximum(z_arr - resid / deriv,0.0)
+        return z_arr.reshape(shp)
+
+    #Redshift for a comoving distance (Mpc), luminosity distance (Mpc), lookback
+    #time (Gyr), or age of the universe (Gyr). All take scalars or arrays.
+    def z_from_dist(self,dc):
+        return self.tab_invert('dc',dc)
+
+    def z_from_lum_dist(self,dl):
+        return self.tab_invert('dl',dl)
+
+    def z_from_lookback(self,lT):
+        return self.tab_invert('lb',np.asarray(lT,dtype='f8') / gyr_conv)
+
+    def z_from_age(self,age):
+        lb_rec = self.tab_interp('lb',z_rec)
+        return self.tab_invert('lb',lb_rec - np.asarray(age,dtype='f8') / gyr_conv)
+
+    #Everything in red_report for a scalar or array of redshifts. One table
+    #lookup each for lookback time and comoving distance, everything else is
+    #derived from those. Returns a dictionary of arrays keyed by report_cols.
+    def report(self,z_arr):
+        z_arr = np.asarray(z_arr,dtype='f8')
+        lb_z = self.tab_interp('lb',z_arr) * gyr_conv
+        lb_rec = self.tab_interp('lb',z_rec) * gyr_conv
+        dc = self.tab_interp('dc',z_arr)
+        dm = self.trans_dist(dc)
+        rep = {'Z':z_arr,
+               'AGE_UNIVERSE':np.full(z_arr.shape,lb_rec), #Gyr
+               'AGE_Z':lb_rec - lb_z, #Gyr
+               'LIGHT_TRAVEL':lb_z, #Gyr
+               'DIST_COMOVE':dc, #Mpc
+               'VOL_COMOVE':self.vol_from_dist(dm), #Gpc^3
+               'DIST_ANG':ang_dist(dm,z_arr), #Mpc
+               'DIST_LUM':lum_dist(dm,z_arr)} #Mpc
+        return rep
+
+#Redshift used as the "beginning" for the age of the universe (recombination).
+z_rec = 1089.0
+report_cols = ['Z','AGE_UNIVERSE','AGE_Z','LIGHT_TRAVEL','DIST_COMOVE','VOL_COMOVE',
+               'DIST_ANG','DIST_LUM']
+report_units = ['','Gyr','Gyr','Gyr','Mpc','Gpc^3','Mpc','Mpc']
+
+#The two parameter sets used for the quasar catalogs. Both are flat (omegaL is
+#1 - omegaM - omegaR).
+DR15Q = Cosmology(69.6,0.286,9.0e-5,name='DR15Q')
+DR14Q = Cosmology(67.8,0.308,9.0e-5,name='DR14Q')
+
+#Returns a Cosmology for the current module level h0/omegaM/omegaR/omegaL/w0/wa.
+#If those are changed, the next call returns a new object (and table) for them.
+cosmo_cache = {}
+def get_cosmo():
+    key = (float(h0),float(omegaM),float(omegaR),float(omegaL),float(w0),float(wa))
+    if key not in cosmo_cache:
+        cosmo_cache[key] = Cosmology(*key[:4],w0=key[4],wa=key[5])
+    return cosmo_cache[key]
+
+#Array version of comove_dist. z_arr can be a scalar or any shape of array
+#(the whole Z column of a catalog, for example). Returns comoving distance in Mpc.
+def comove_dist_arr(z_arr):
+    return get_cosmo().comove_dist(z_arr,quad=True)
+
+#Returns the comoving, luminosity, and angular size distances (all in Mpc) for
+#an array of redshifts in one pass.
+def dist_arr(z_arr):
+    return get_cosmo().dist(z_arr,quad=True)
+
+#Table based comoving distance (Mpc) and lookback time (Gyr). See Cosmology.
+def comove_dist_tab(z_arr):
+    return get_cosmo().comove_dist(z_arr)
+
+def lookback_time_tab(z_l,z_p):
+    return get_cosmo().lookback_time(z_l,z_p)
+
+#Error controlled versions of comove_dist and lookback_time. rtol is the relative
+#tolerance asked for. Both return (value, error estimate, function evaluations),
+#with the error estimate in the same units as the value (Mpc or Gyr).
+def comove_dist_adapt(z_p,rtol=1.0e-8):
+    return get_cosmo().comove_dist_adapt(z_p,rtol=rtol)
+
+def lookback_time_adapt(z_l,z_p,rtol=1.0e-8):
+    return get_cosmo().lookback_time_adapt(z_l,z_p,rtol=rtol)
+
+
+#Comoving volume (Gpc^3) between z_lo and z_hi for a fraction of the sky.
+def comove_vol_shell(z_lo,z_hi,sky_frac=1.0):
+    return get_cosmo().comove_vol_shell(z_lo,z_hi,sky_frac=sky_frac)
+
+#Fraction of the sky covered by a survey area given in square degrees.
+def sky_frac_area(area):
+    return area / (4.0 * np.pi * (180.0 / np.pi)**2)
+
+#Inverse cosmology for the module level parameters. Redshift from a comoving
+#distance (Mpc), a luminosity distance (Mpc), a lookback time (Gyr), or the age
+#of the universe (Gyr).
+def z_from_dist(dc):
+    return get_cosmo().z_from_dist(dc)
+
+def z_from_lum_dist(dl):
+    return get_cosmo().z_from_lum_dist(dl)
+
+def z_from_lookback(lT):
+    return get_cosmo().z_from_lookback(lT)
+
+def z_from_age(age):
+    return get_cosmo().z_from_age(age)
+
 #Calculate the Luminosity distance from comoving distance and redshift.
 def lum_dist(dp,z_l):
     #dp must in input as Mpc
@@ -122,17 +605,74 @@ def dist_mod(dl):
     return 5*np.log10(dl) + 25 #unitless
 
 #Table is for i-band only and is loaded from Richards et. al. (2006)
-def k_corr(z_k):
-    k_table = np.loadtxt('k_corr_tab.dat',dtype='f4',delimiter=',') #Load k-correction table
-    diff_arr = np.absolute(z_k-k_table[:,0]) #Find the difference between our redshift and table.
-    min_diff = np.amin(diff_arr) #Find the minimum difference
-    wmin = np.where(diff_arr == min_diff)[0] #Find the address of the minimum distance.
-    kC = k_table[wmin[0],1] #Find the k-correction value for that redshift (usually 2.0).
-    return kC #Return the k-correction, unitless (it's a magnitude correction).
+#The table is read once per process and kept in kcorr_cache. It is found next
+#to this file, not in the current working directory.
+kcorr_file = os.path.join(tab_dir,'k_corr_tab.dat')
+kcorr_cache = {}
+def load_kcorr(kfile=kcorr_file):
+    if kfile not in kcorr_cache:
+        k_table = np.loadtxt(kfile,dtype='f4',delimiter=',') #Load k-correction table
+        srt = np.argsort(k_table[:,0],kind='stable')
+        kcorr_cache[kfile] = (k_table[srt,0],k_table[srt,1])
+    return kcorr_cache[kfile]
+
+#z_k can be a scalar or an array. interp='nearest' takes the closest redshift
+#in the table (the lower one on a tie), interp='linear' interpolates between the
+#two table entries around z_k. Redshifts off the ends of the table get the end
+#values either way.
+def k_corr(z_k,interp='nearest',kfile=kcorr_file):
+    kz,kval = load_kcorr(kfile)
+    z_k = np.asarray(z_k)
+    if interp == 'linear':
+        kC = np.interp(z_k,kz,kval).astype('f4')
+    else:
+        idx = np.clip(np.searchsorted(kz,z_k),1,len(kz)-1)
+        #Step back one if the table entry below is at least as close.
+        idx = idx - ((z_k - kz[idx-1]) <= (kz[idx] - z_k))
+        kC = kval[idx]
+    if kC.ndim == 0:
+        return kC[()] #Return the k-correction, unitless (it's a magnitude correction).
+    return kC
+
+#Per-band k-corrections. The i-band table above is the only one that comes with
+#this file. A table for another band goes next to it as k_corr_tab_<band>.dat
+#(same format) and is loaded once, like the i-band one. A band without a table
+#is an error unless fallback='powerlaw' is given, which uses the power-law
+#continuum k-correction with slope alphaV instead (with a warning, since it is
+#not the same convention as the tables).
+band_list = 'ugriz'
+alphaV = -0.5
+kcorr_fallbacks = [None,'powerlaw']
+def kcorr_band_file(band):
+    if band == 'i':
+        return kcorr_file
+    return os.path.join(tab_dir,'k_corr_tab_{}.dat'.format(band))
+
+#Which k-correction a band gets: 'table' or 'powerlaw'.
+def kcorr_kind(band,fallback=None):
+    if fallback not in kcorr_fallbacks:
+        raise ValueError("fallback must be None or 'powerlaw', not {}".format(fallback))
+    kfile = kcorr_band_file(band)
+    if (kfile in kcorr_cache) | os.path.exists(kfile):
+        return 'table'
+    if fallback is None:
+        raise ValueError("No k-correction table for the {} band ({}), give fallback='powerlaw' "
+                         "to use the power law instead".format(band,kfile))
+    return 'powerlaw'
+
+def k_corr_band(z_k,band='i',interp='nearest',fallback=None):
+    if kcorr_kind(band,fallback=fallback) == 'table':
+        return k_corr(z_k,interp=interp,kfile=kcorr_band_file(band))
+    warnings.warn('No k-correction table for the {} band, using the power law with '
+                  'alpha={}'.format(band,alphaV),stacklevel=2)
+    kC = (-2.5*(1+alphaV)*np.log10(1+np.asarray(z_k,dtype='f8'))).astype('f4')
+    if kC.ndim == 0:
+        return kC[()]
+    return kC
 
 #Find the absolute magnitude given the previously calculated values and object
 #apparent magnitude and galactic extinction.
-#Only good for i-band.
+#Good for any band, as long as kC is the k-correction for that band.
 def abs_Mag(apmag,ext,dm,kC):
     #apmag is the apparent magnitude, ext is galactic extinction
     #dm is distance modulus from dist_mod, and kC is k correction from k_corr.
@@ -141,32 +681,47 @@ def abs_Mag(apmag,ext,dm,kC):
 #For getting an absolute magnitude from the program. Example for a QSO with
 #redshift of 2.355, apparent magnitude of 20.56, and extinction of 0.045:
 #mag_test(2.355,20.56,0.045)
-def mag_test(z_test,amag,a_i):
+#For more than one band give amag and a_i as lists and the bands, like
+#mag_test(2.355,[21.1,20.8,20.6,20.56,20.4],[0.09,0.07,0.05,0.045,0.03],bands='ugriz')
+#The distance is only calculated once for all of them. Bands without a k-correction
+#table need fallback='powerlaw' (see k_corr_band).
+def mag_test(z_test,amag,a_i,bands='i',fallback=None):
     Dp = comove_dist(z_test)
     Dl = lum_dist(Dp,z_test)
     Dm = dist_mod(Dl)
-    Kc = k_corr(2.0)
-    Mag = abs_Mag(amag,a_i,Dm,Kc)
+    amag,a_i = np.atleast_1d(amag),np.atleast_1d(a_i)
     tstr1 = ' '*3 +'Z'+' '*3+'|'+' '*4+'Dp'+' '*6+'|'+' '*5+'Dl'+' '*5+'|'+' '*4+'Mag'
     brkr = '-'*44
-    tstr = '{0:6.4f} | {1:6.1f} Mpc | {2:7.1f} Mpc| {3:9.5f}'.format(z_test,Dp,Dl,Mag)
     print(tstr1)
     print(brkr)
-    print(tstr)
+    for i,band in enumerate(bands):
+        Kc = k_corr_band(2.0,band,fallback=fallback)
+        Mag = abs_Mag(amag[i],a_i[i],Dm,Kc)
+        tstr = '{0:6.4f} | {1:6.1f} Mpc | {2:7.1f} Mpc| {3:9.5f}'.format(z_test,Dp,Dl,Mag)
+        if len(bands) > 1:
+            tstr = '{} {}'.format(tstr,band)
+        print(tstr)
 
 #This will generated a report on the universe and calculated distances/ages
 #for a given redshift, then output to the terminal. Also reports the redshift
-#given, density parameters used, and the Hubble constant.
-def red_report(z_in):
-    uni_age = np.round(lookback_time(0,1089),1) #Gyr
-    age_z = np.round(lookback_time(z_in,1089),1) #Gyr
-    age_light = np.round(lookback_time(0,z_in),1) #Gyr
-    coradial = np.round(comove_dist(z_in),1) #In Mpc
-    covol = np.round(comove_vol(z_in),2) #In Gpc^3
-    size_ang = np.round(ang_dist(coradial,z_in),1) #In Mpc
-    lumdist = np.round(lum_dist(coradial,z_in),1)
+#given, density parameters used, and the Hubble constant. Pass a Cosmology as
+#cosmo to use something other than the module level parameters.
+def red_report(z_in,cosmo=None):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    rep = cosmo.report(z_in)
+    uni_age = np.round(rep['AGE_UNIVERSE'],1) #Gyr
+    age_z = np.round(rep['AGE_Z'],1) #Gyr
+    age_light = np.round(rep['LIGHT_TRAVEL'],1) #Gyr
+    coradial = np.round(rep['DIST_COMOVE'],1) #In Mpc
+    covol = np.round(rep['VOL_COMOVE'],2) #In Gpc^3
+    size_ang = np.round(rep['DIST_ANG'],1) #In Mpc
+    lumdist = np.round(rep['DIST_LUM'],1)
     print('\n')
-    print('Redshift: {}, Wm: {}, Wr: {}, Wl: {:0.3f}, H0: {}'.format(z_in,omegaM,omegaR,omegaL,h0))
+    print('Redshift: {}, Wm: {}, Wr: {}, Wl: {:0.3f}, H0: {}'.format(z_in,cosmo.omegaM,
+            cosmo.omegaR,cosmo.omegaL,cosmo.h0))
+    if (cosmo.omegaK != 0.0) | (cosmo.w0 != -1.0) | (cosmo.wa != 0.0):
+        print('Wk: {:0.3f}, w0: {}, wa: {}'.format(cosmo.omegaK,cosmo.w0,cosmo.wa))
     print('---------------------------------------------------------')
     print('Age of Universe:   {:7.1f} Gyr'.format(uni_age))
     print('Age at Redshift:   {:7.1f} Gyr'.format(age_z))
@@ -177,6 +732,197 @@ def red_report(z_in):
     print('Luminosity Dist:   {:7.1f} Mpc'.format(lumdist))
     print('\n')
 
+#Loads redshifts for the batch report. zin can be an array, a FITS table with a
+#Z column, or a text file with one redshift per line (or Z in the first column).
+def load_reds(zin):
+    if not isinstance(zin,str):
+        return np.asarray(zin,dtype='f8').ravel()
+    if zin.lower().endswith(('.fits','.fits.gz','.fit')):
+        from astropy.io import fits #Only needed here, so keep cosmo_calc imports light.
+        with fits.open(zin) as hdul:
+            return np.array(hdul[1].data['Z'],dtype='f8')
+    return np.loadtxt(zin,dtype='f8',delimiter=',',usecols=0,ndmin=1)
+
+#The report as a tuple of arrays in report_cols order. Used by the worker
+#processes in red_report_batch.
+def report_arrs(z_arr,cosmo):
+    rep = cosmo.report(z_arr)
+    return tuple([rep[cn] for cn in report_cols])
+
+#Batch version of red_report. Takes an array or file of redshifts (see load_reds)
+#and writes the full report table to ofile as CSV, or FITS if ofile ends in .fits.
+#workers > 1 splits the redshifts over a pool of processes (see shared_pool),
+#which gives exactly the same numbers as workers=1. Returns the report dictionary.
+def red_report_batch(zin,ofile,cosmo=None,workers=1):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    z_arr = load_reds(zin)
+    if workers > 1:
+        cosmo.table() #Build (and save) the table once, so the workers just load it.
+        rep_list = spl.pool_run(report_arrs,[z_arr],['f8']*len(report_cols),workers,
+                                kwargs={'cosmo':cosmo})
+        rep = dict(zip(report_cols,rep_list))
+    else:
+        rep = cosmo.report(z_arr)
+    if ofile.lower().endswith('.fits'):
+        from astropy.io import fits
+        cols = [fits.Column(name=cn,format='D',unit=cu,array=rep[cn])
+                for cn,cu in zip(report_cols,report_units)]
+        data_out = fits.BinTableHDU.from_columns(cols)
+        for hname,hval in zip(['H0','OMEGAM','OMEGAR','OMEGAL','W0','WA'],cosmo.key()):
+            data_out.header[hname] = hval
+        data_out.writeto(ofile,overwrite=True)
+    else:
+        hdr = 'H0: {}, Wm: {}, Wr: {}, Wl: {}, w0: {}, wa: {}\n'.format(cosmo.h0,
+                cosmo.omegaM,cosmo.omegaR,cosmo.omegaL,cosmo.w0,cosmo.wa) + ','.join(report_cols)
+        np.savetxt(ofile,np.column_stack([rep[cn] for cn in report_cols]),
+                   delimiter=',',fmt='%.8g',header=hdr)
+    return rep
+
+#Query server. Keeps the process (and so the imports and cached tables) alive and
+#answers one JSON request per line, from stdin or a local UNIX socket. A request
+#looks like
+#   {"z": 2.355}  or  {"z": [0.5, 1.0, 2.0], "cols": ["DIST_LUM"], "id": 7}
+#and can pick the cosmology with "cosmo": "DR14Q" (or "DR15Q"), or a dictionary
+#of Cosmology arguments like {"h0": 70, "omegaM": 0.3, "omegaL": 0.65, "w0": -0.9}.
+#The answer has the report_cols (or just cols) for each redshift, scalars for a
+#scalar z and lists for a list, plus the id if one was sent. Bad requests get
+#{"error": message} back and the server keeps going. That includes a cosmology
+#dictionary with arguments that aren't finite numbers, or with no real distances
+#(its table is built, and checked, before it is used or kept).
+named_cosmo = {'DR15Q':DR15Q,'DR14Q':DR14Q}
+cosmo_args = ['h0','omegaM','omegaR','omegaL','w0','wa']
+server_cache = {} #Cosmology objects made for requests, by their arguments.
+server_max = 32 #Most request cosmologies kept at once, the oldest goes first.
+
+def req_cosmo(cpar,cosmo):
+    if cpar is None:
+        return cosmo
+    if isinstance(cpar,str):
+        return named_cosmo[cpar]
+    if not isinstance(cpar,dict):
+        raise TypeError('cosmo must be a name or a dictionary, not {}'.format(type(cpar).__name__))
+    bad_args = [arg for arg in cpar if arg not in cosmo_args]
+    if len(bad_args) > 0:
+        raise KeyError('unknown cosmo arguments {}'.format(bad_args))
+    for arg,val in cpar.items():
+        try:
+            good = (not isinstance(val,bool)) & isinstance(val,(int,float)) and np.isfinite(float(val))
+        except OverflowError:
+            good = False
+        if not good:
+            raise ValueError('cosmo {} must be a finite number, not {!r:.40}'.format(arg,val))
+    ckey = tuple(sorted(cpar.items()))
+    if ckey not in server_cache:
+        new_cosmo = Cosmology(**cpar)
+        new_cosmo.table() #Raises here for a cosmology with no real distances.
+        if len(server_cache) >= server_max:
+            old_cosmo = server_cache.pop(next(iter(server_cache)))
+            keep_keys = [cosmo.key()] + [ncosmo.key() for ncosmo in named_cosmo.values()]
+            if old_cosmo.key() not in keep_keys:
+                tab_cache.pop(old_cosmo.key(),None) #Its table goes too.
+        server_cache[ckey] = new_cosmo
+    return server_cache[ckey]
+
+#Array (or scalar) to JSON ready values. nan/inf (redshifts off the table, like
+#z < -1) aren't valid JSON, so they come back as null.
+def json_vals(arr):
+    arr = np.asarray(arr,dtype='f8')
+    return np.where(np.isfinite(arr),arr,None).tolist()
+
+#Answers one request dictionary. Used by the server, but works on its own too.
+def query(req,cosmo=None):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    try:
+        cols = req.get('cols',report_cols)
+        bad_cols = [cn for cn in cols if cn not in report_cols]
+        if len(bad_cols) > 0:
+            raise KeyError('unknown columns {}'.format(bad_cols))
+        with np.errstate(invalid='ignore'): #Off table redshifts just come back null.
+            rep = req_cosmo(req.get('cosmo'),cosmo).report(req['z'])
+        resp = {cn:json_vals(rep[cn]) for cn in cols}
+    except (KeyError,TypeError,ValueError) as err:
+        resp = {'error':'{}: {}'.format(type(err).__name__,err)}
+    if 'id' in req:
+        resp['id'] = req['id']
+    return resp
+
+#Reads requests from in_file (one JSON object per line) and writes the answers,
+#one per line, to out_file. Blank lines are skipped. Anything that goes wrong
+#with one request is sent back as an error, so the server keeps running.
+def serve_lines(in_file,out_file,cosmo):
+    for line in in_file:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            req = json.loads(line)
+        except ValueError as err:
+            req = None
+            resp = {'error':'bad JSON: {}'.format(err)}
+        try:
+            if isinstance(req,dict):
+                resp = query(req,cosmo)
+            elif req is not None:
+                resp = {'error':'request must be an object'}
+            resp_str = json.dumps(resp,allow_nan=False)
+        except Exception as err:
+            resp_str = json.dumps({'error':'{}: {}'.format(type(err).__name__,err)})
+        out_file.write(resp_str + '\n')
+        out_file.flush()
+
+#Runs the server. sock_path=None answers on stdin/stdout, otherwise it listens
+#on a UNIX socket at sock_path (each connection gets its own thread, and they
+#all share the tables). The default cosmology's table is built or loaded first,
+#so the first query is as fast as the rest.
+def serve(sock_path=None,cosmo=None):
+    if cosmo is None:
+        cosmo = get_cosmo()
+    cosmo.table()
+    if sock_path is None:
+        serve_lines(sys.stdin,sys.stdout,cosmo)
+        return
+    import socketserver #Only needed here, so keep cosmo_calc imports light.
+    class QueryHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_lines(io.TextIOWrapper(self.rfile,encoding='utf-8'),
+                        io.TextIOWrapper(self.wfile,encoding='utf-8',write_through=True),cosmo)
+    if os.path.exists(sock_path):
+        os.remove(sock_path) #Left over from a server that didn't shut down cleanly.
+    import signal
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0)) #Clean up on kill too.
+    with socketserver.ThreadingUnixStreamServer(sock_path,QueryHandler) as server:
+        server.daemon_threads = True
+        print('cosmo_calc serving {} on {}'.format(cosmo,sock_path),file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(sock_path)
+
+#Client side for scripts: sends one request to the server at sock_path and
+#returns the answer. Open a socket yourself and keep it to send many requests.
+def ask(sock_path,req):
+    import socket
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+        sock.connect(sock_path)
+        with sock.makefile('rw',encoding='utf-8') as sf:
+            sf.write(json.dumps(req) + '\n')
+            sf.flush()
+            return json.loads(sf.readline())
+
+#python cosmo_calc.py <z> prints the report for one redshift.
+#python cosmo_calc.py <redshift file> <output .csv or .fits> [workers] runs the
+#batch report.
+#python cosmo_calc.py --serve [socket path] runs the query server (stdin without
+#a socket path).
 if __name__=='__main__':
-	user_z = float(sys.argv[1])
-	red_report(user_z)
+    if sys.argv[1] == '--serve':
+        serve(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 2:
+        num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+        red_report_batch(sys.argv[1],sys.argv[2],workers=num_workers)
+    else:
+        user_z = float(sys.argv[1])
+        red_report(user_z)
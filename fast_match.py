@@ -1,22 +1,34 @@
 #This program is designed to find all of the matches in two different fits
 #flat files, finding the addresses where the objects in 1 match the objects in 2.
 #rec_match and rec_match_srt only work well with hash arrays (they compare one array)
-#so you will need to use mk_hsh_arr first to make PMF hash arrays for each fits
-#flat file.
+#so you will need to use mk_key (or mk_hsh_arr) first to make PMF hash arrays for
+#each fits flat file. The integer keys from mk_key are the fast ones.
 
 #Neither rec_match function should be used if you are just trying to find one or
 #two matches. These are for large numbers of matches to be made.
 
+#rec_match_auto is the front end for matched pairs. It picks between the sort-merge
+#join (rec_join) and the hash join (hash_join) from the sizes and key type.
+
 #Code and ideas for rec_match lifted from https://www.followthesheep.com/?p=1366.
 
 from astropy.io import fits
 import numpy as np
+import os
+import json
+import shutil
+import tempfile
 import tmark
-import progressBar as pb
 
 #This is the very slow version. It's brute force. It can take a while. Not to be
 #used with very large arrays of objects. Still needs PMF hash arrays.
-def rec_match(rec1,rec2):
+#It's O(N*M), so it refuses to run when len(rec1)*len(rec2) is more than
+#brute_max unless force=True. Use rec_match_auto for those.
+brute_max = 10**7
+def rec_match(rec1,rec2,force=False):
+    if (len(rec1) * len(rec2) > brute_max) & (force == False):
+        raise ValueError('rec_match is O(N*M) and {} x {} is too big, use rec_match_auto '
+                         '(or force=True)'.format(len(rec1),len(rec2)))
     tmark.tm('Starting Record Match')
     bool_rec1 = np.in1d(rec1,rec2)
     rec1_adr = np.arange(len(rec1))
@@ -28,33 +40,528 @@ def rec_match(rec1,rec2):
     return rec1_adr,rec2_adr
 
 #This works much faster than rec_match and will work with non-unique values.
-#I'm not sure what it does with non-uniques though.
+#It returns every address in 1 whose key is somewhere in 2 and every address in
+#2 whose key is somewhere in 1, each sorted by key, so with non-uniques the two
+#arrays don't line up. Use rec_join to get matched pairs.
 def rec_match_srt(rec1,rec2):
+    rec1,rec2 = np.asarray(rec1),np.asarray(rec2)
     rec1a = np.argsort(rec1)
     rec2a = np.argsort(rec2)
     tmark.tm('Starting Searchsorted')
-    sort_left_rec1 = rec1[rec1a].searchsorted(rec2[rec2a],side='left')
-    sort_right_rec1 = rec1[rec1a].searchsorted(rec2[rec2a],side='right')
-    sort_left_rec2 = rec2[rec2a].searchsorted(rec1[rec1a],side='left')
-    sort_right_rec2 = rec2[rec2a].searchsorted(rec1[rec1a],side='right')
+    return rec_match_sorted(rec1[rec1a],rec1a,rec2[rec2a],rec2a)
+
+#rec_match_srt for keys that are already sorted: key1 = rec1[srt1] and
+#key2 = rec2[srt2], like the ones from pmf_index.
+def rec_match_sorted(key1,srt1,key2,srt2):
+    sort_left_rec1 = key1.searchsorted(key2,side='left')
+    sort_right_rec1 = key1.searchsorted(key2,side='right')
+    sort_left_rec2 = key2.searchsorted(key1,side='left')
+    sort_right_rec2 = key2.searchsorted(key1,side='right')
 
     rec2_adr = (sort_right_rec1 - sort_left_rec1 > 0).nonzero()[0]
     rec1_adr = (sort_right_rec2 - sort_left_rec2 > 0).nonzero()[0]
 
-    return rec1a[rec1_adr],rec2a[rec2_adr]
+    return srt1[rec1_adr],srt2[rec2_adr]
 
-#Makes a PMF hash array. Useful outside the rec_match context. Necessary for
-#rec_match and rec_match_srt.
+#Makes a PMF hash array of strings. Useful outside the rec_match context.
+#Same strings as always, but built from the integer keys with array arithmetic.
 def mk_hsh_arr(rec_arr):
     tmark.tm('Creating Hash Array')
-    num_rec = len(rec_arr)
-    rec_hsh = np.chararray(num_rec,itemsize=16,unicode=True)
-    for i in range(num_rec):
-        pt = rec_arr['PLATE'][i]
-        mt = rec_arr['MJD'][i]
-        ft = rec_arr['FIBERID'][i]
-        hst = '{0:05d}-{1:05d}-{2:04d}'.format(pt,mt,ft)
-        rec_hsh[i] = hst
-        pb.pbar(i,num_rec)
-
-    return rec_hsh
+    return key_str(mk_key(rec_arr))
+
+#Integer PMF keys. PLATE/MJD/FIBERID are packed into one int64 per row:
+#   PMF: plate*10^9 + mjd*10^4 + fiber
+#   PM:  plate*10^5 + mjd
+#   PF:  plate*10^4 + fiber
+#which sort in the same order as the '%05d-%05d-%04d' strings, take 8 bytes each
+#instead of 64, and are made with whole column arithmetic. MJD has to fit in 5
+#digits and FIBERID in 4 (same as the strings), or a ValueError is raised.
+#include_fiber and include_mjd pick PMF, PM, or PF, like cat_tools.mk_hash.
+key_digits = {'MJD':5,'FIBERID':4}
+
+def key_fields(include_fiber=True,include_mjd=True):
+    if (include_fiber==False)&(include_mjd==False):
+        raise ValueError('A key needs MJD, FIBERID, or both')
+    return [fld for fld,used in [('MJD',include_mjd),('FIBERID',include_fiber)] if used]
+
+def mk_key(rec_arr,include_fiber=True,include_mjd=True,pname='PLATE',mname='MJD',fibname='FIBERID'):
+    col_names = {'MJD':mname,'FIBERID':fibname}
+    keys = np.asarray(rec_arr[pname],dtype='i8')
+    if np.any(keys < 0):
+        raise ValueError('{} has negative values, which can not be packed in a key'.format(pname))
+    for fld in key_fields(include_fiber,include_mjd):
+        col_arr = np.asarray(rec_arr[col_names[fld]],dtype='i8')
+        if np.any((col_arr < 0) | (col_arr >= 10**key_digits[fld])):
+            raise ValueError('{} does not fit in {} digits'.format(col_names[fld],key_digits[fld]))
+        keys = keys * 10**key_digits[fld] + col_arr
+    return keys
+
+#Unpacks keys from mk_key. Returns a list of arrays: plate, then mjd and/or fiber.
+def key_split(keys,include_fiber=True,include_mjd=True):
+    keys = np.asarray(keys,dtype='i8')
+    parts = []
+    for fld in key_fields(include_fiber,include_mjd)[::-1]:
+        keys,part = np.divmod(keys,10**key_digits[fld])
+        parts.insert(0,part)
+    return [keys] + parts
+
+#Zero padded decimal digits of non-negative integers, as a (N, width) array of
+#ASCII codes.
+def zpad(vals,width):
+    pows = 10**np.arange(width-1,-1,-1,dtype='i8')
+    return ((vals[:,None] // pows) % 10 + ord('0')).astype('u1')
+
+#Turns keys from mk_key back into the '%05d-%05d-%04d' style strings, for display
+#or to compare with older string hash arrays. Like '%05d', a plate past 99999
+#just gets wider, without changing the padding of any other row.
+def key_str(keys,include_fiber=True,include_mjd=True):
+    parts = key_split(np.ravel(keys),include_fiber,include_mjd)
+    plate_digits = np.maximum(5,np.searchsorted(10**np.arange(1,19,dtype='i8'),parts[0],side='right') + 1)
+    widths = [int(np.amax(plate_digits,initial=5))]
+    widths += [key_digits[fld] for fld in key_fields(include_fiber,include_mjd)]
+    dash = np.full((len(parts[0]),1),ord('-'),dtype='u1')
+    chars = [zpad(parts[0],widths[0])]
+    for part,width in zip(parts[1:],widths[1:]):
+        chars += [dash,zpad(part,width)]
+    chars = np.hstack(chars)
+    str_len = chars.shape[1]
+    if widths[0] > 5:
+        #Shift each row left past the padding it doesn't need. The trailing nulls
+        #this leaves are dropped by the string conversion.
+        cols = np.arange(str_len) + (widths[0] - plate_digits)[:,None]
+        chars = np.where(cols < str_len,np.take_along_axis(chars,np.minimum(cols,str_len-1),axis=1),0)
+    chars = np.ascontiguousarray(chars,dtype='u1')
+    return chars.view('S{}'.format(str_len))[:,0].astype('U{}'.format(str_len)).reshape(np.shape(keys))
+
+#Sort-merge join of two key arrays (PMF keys from mk_key, or any sortable array).
+#Returns aligned address arrays adr1,adr2 where rec1[adr1] == rec2[adr2], with
+#one entry for every pair, so a key that is in 1 twice and in 2 three times
+#gives six pairs. how is
+#   'inner' - only matched pairs
+#   'left'  - plus the rows of 1 with no match, with adr2 = -1
+#   'outer' - plus the rows of 2 with no match as well, with adr1 = -1
+#Pairs come out in key order (ties in address order), with the unmatched rows
+#of 2 for 'outer' at the end. unique=True raises a ValueError if a key is
+#repeated on either side. counts=True also returns the multiplicities: for each
+#row of 1 how many rows of 2 it matches, and the same for each row of 2.
+#Two sorts and some searchsorted calls, so O((N+M) log(N+M)) and no Python loops.
+def rec_join(rec1,rec2,how='inner',unique=False,counts=False):
+    if how not in ['inner','left','outer']:
+        raise ValueError("how must be 'inner', 'left', or 'outer', not {}".format(how))
+    rec1,rec2 = np.asarray(rec1),np.asarray(rec2)
+    srt1 = np.argsort(rec1,kind='stable')
+    srt2 = np.argsort(rec2,kind='stable')
+    return rec_join_sorted(rec1[srt1],srt1,rec2[srt2],srt2,how=how,unique=unique,counts=counts)
+
+#The merge part of rec_join, for keys that are already sorted: key1 = rec1[srt1]
+#and key2 = rec2[srt2] (from pmf_index, for example).
+def rec_join_sorted(key1,srt1,key2,srt2,how='inner',unique=False,counts=False):
+    if how not in ['inner','left','outer']:
+        raise ValueError("how must be 'inner', 'left', or 'outer', not {}".format(how))
+    if unique == True:
+        for key_srt,side in [(key1,1),(key2,2)]:
+            num_dup = np.count_nonzero(key_srt[1:] == key_srt[:-1])
+            if num_dup > 0:
+                raise ValueError('{} repeated keys in rec{}'.format(num_dup,side))
+    #Where each sorted key of 1 starts and stops in sorted 2 (and the reverse).
+    lo1 = key2.searchsorted(key1,side='left')
+    num1 = key2.searchsorted(key1,side='right') - lo1
+    num2 = key1.searchsorted(key2,side='right') - key1.searchsorted(key2,side='left')
+    #Each row of 1 is repeated once per match (once anyway for left/outer), and
+    #steps through its block of matching rows in 2.
+    num_out = num1 if how == 'inner' else np.maximum(num1,1)
+    rep1 = np.repeat(np.arange(len(key1)),num_out)
+    step = np.arange(len(rep1)) - np.repeat(np.cumsum(num_out) - num_out,num_out)
+    adr1 = srt1[rep1]
+    adr2 = np.full(len(rep1),-1,dtype='i8')
+    wmatch = num1[rep1] > 0
+    adr2[wmatch] = srt2[lo1[rep1[wmatch]] + step[wmatch]]
+    if how == 'outer':
+        wleft2 = srt2[num2 == 0]
+        adr1 = np.concatenate((adr1,np.full(len(wleft2),-1,dtype=adr1.dtype)))
+        adr2 = np.concatenate((adr2,wleft2))
+    if counts == True:
+        cnt1 = np.empty(len(key1),dtype='i8')
+        cnt2 = np.empty(len(key2),dtype='i8')
+        cnt1[srt1],cnt2[srt2] = num1,num2
+        return adr1,adr2,cnt1,cnt2
+    return adr1,adr2
+
+#Adds the unmatched rows to a list of matched pairs for left and outer joins.
+#cnt1 and cnt2 are the number of matches for each row of 1 and 2.
+def add_unmatched(adr1,adr2,cnt1,cnt2,how):
+    if how in ['left','outer']:
+        wleft1 = (cnt1 == 0).nonzero()[0]
+        adr1 = np.concatenate((adr1,wleft1))
+        adr2 = np.concatenate((adr2,np.full(len(wleft1),-1,dtype='i8')))
+    if how == 'outer':
+        wleft2 = (cnt2 == 0).nonzero()[0]
+        adr1 = np.concatenate((adr1,np.full(len(wleft2),-1,dtype='i8')))
+        adr2 = np.concatenate((adr2,wleft2))
+    return adr1,adr2
+
+#Vectorized open addressing hash table (linear probing) for integer keys.
+#hash_slot is Fibonacci hashing: multiply by 2^64/golden ratio and keep the top
+#bits. hash_build puts unique keys in a table at most a quarter full (so most
+#misses stop at the first slot), a round of vectorized inserts at a time
+#(collisions move on to the next slot and try again next round). The table
+#holds the address of each key, plus a copy of the keys in slot order so a
+#lookup only needs one gather. hash_find returns the address in keys of each of
+#find_keys, or -1.
+hash_load = 4 #Table slots per key.
+def hash_slot(keys,bits):
+    return ((keys.astype('u8') * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - bits)).astype('i8')
+
+def hash_build(keys):
+    bits = max(int(np.ceil(np.log2(hash_load * len(keys) + 1))),1)
+    table = np.full(2**bits,-1,dtype='i8')
+    slot = hash_slot(keys,bits)
+    todo = np.arange(len(keys))
+    while len(todo) > 0:
+        wopen = table[slot[todo]] == -1
+        cand = todo[wopen]
+        table[slot[cand]] = cand #Where several want one slot, one of them gets it.
+        wlost = table[slot[cand]] != cand
+        todo = np.concatenate((todo[~wopen],cand[wlost]))
+        slot[todo] = (slot[todo] + 1) & (len(table) - 1)
+    table_keys = np.zeros(len(table),dtype=keys.dtype)
+    table_keys[table >= 0] = keys[table[table >= 0]]
+    return table,table_keys,bits
+
+def hash_find(hash_tab,find_keys):
+    table,table_keys,bits = hash_tab
+    found = np.full(len(find_keys),-1,dtype='i8')
+    slot = hash_slot(find_keys,bits)
+    todo = np.arange(len(find_keys))
+    while len(todo) > 0:
+        ent = table[slot]
+        whit = (ent >= 0) & (table_keys[slot] == find_keys)
+        found[todo[whit]] = ent[whit]
+        #Keep going on the ones that hit a different key. An empty slot is a miss.
+        wnext = (ent >= 0) & ~whit
+        todo,find_keys = todo[wnext],find_keys[wnext]
+        slot = (slot[wnext] + 1) & (len(table) - 1)
+    return found
+
+#Hash join of two integer key arrays, same arguments and returns as rec_join.
+#Only the smaller side is sorted (to group its repeats) and put in the hash
+#table; the bigger side is looked up in it without sorting, so this wins when
+#one catalog is much smaller than the other. Pairs come out in the order of the
+#bigger side's addresses, with the unmatched rows for left/outer at the end.
+def hash_join(rec1,rec2,how='inner',unique=False,counts=False):
+    if how not in ['inner','left','outer']:
+        raise ValueError("how must be 'inner', 'left', or 'outer', not {}".format(how))
+    rec1,rec2 = np.asarray(rec1),np.asarray(rec2)
+    if (rec1.dtype.kind not in 'iu') | (rec2.dtype.kind not in 'iu'):
+        raise ValueError('hash_join needs integer keys (see mk_key)')
+    #Compare both sides at a type that holds either one, so wide keys don't wrap
+    #into false matches. u8 with a signed type has no such integer type.
+    key_dtype = np.result_type(rec1,rec2)
+    if key_dtype.kind not in 'iu':
+        raise ValueError('hash_join needs keys with a common integer type, not {} and {}'.format(rec1.dtype,rec2.dtype))
+    rec1,rec2 = rec1.astype(key_dtype,copy=False),rec2.astype(key_dtype,copy=False)
+    swap = len(rec1) < len(rec2) #Build the table on the smaller side.
+    probe,build = (rec2,rec1) if swap else (rec1,rec2)
+    build_keys,build_grp,build_cnt = np.unique(build,return_inverse=True,return_counts=True)
+    if unique == True:
+        num_dup = [len(rec) - len(np.unique(rec)) for rec in [rec1,rec2]]
+        if max(num_dup) > 0:
+            side = 1 if num_dup[0] > 0 else 2
+            raise ValueError('{} repeated keys in rec{}'.format(num_dup[side-1],side))
+    probe_grp = hash_find(hash_build(build_keys),probe)
+    #Build side rows grouped by key, so each group is a block of build_srt.
+    build_srt = np.argsort(build_grp.ravel(),kind='stable')
+    grp_start = np.cumsum(build_cnt) - build_cnt
+    whit = probe_grp >= 0
+    probe_cnt = np.zeros(len(probe),dtype='i8')
+    probe_cnt[whit] = build_cnt[probe_grp[whit]]
+    rep_probe = np.repeat(np.arange(len(probe)),probe_cnt)
+    step = np.arange(len(rep_probe)) - np.repeat(np.cumsum(probe_cnt) - probe_cnt,probe_cnt)
+    adr_build = build_srt[grp_start[probe_grp[rep_probe]] + step]
+    grp_hits = np.bincount(probe_grp[whit],minlength=len(build_keys))
+    build_hits = grp_hits[build_grp.ravel()]
+    if swap:
+        adr1,adr2,cnt1,cnt2 = adr_build,rep_probe,build_hits,probe_cnt
+    else:
+        adr1,adr2,cnt1,cnt2 = rep_probe,adr_build,probe_cnt,build_hits
+    adr1,adr2 = add_unmatched(adr1,adr2,cnt1,cnt2,how)
+    if counts == True:
+        return adr1,adr2,cnt1.astype('i8'),cnt2.astype('i8')
+    return adr1,adr2
+
+#Matched pairs from either engine. engine='auto' uses the hash join for integer
+#keys when one side is at least hash_ratio times bigger than the other, and the
+#sort-merge join (rec_join) otherwise (and always for strings or floats, or when
+#unique=True, which has to sort both sides anyway). engine='hash' or 'merge'
+#forces one. The engine used is kept in last_engine and printed with the timing
+#mark. Same arguments and returns as rec_join; only the order of the pairs
+#depends on the engine.
+hash_ratio = 4
+last_engine = None
+def rec_match_auto(rec1,rec2,how='inner',unique=False,counts=False,engine='auto'):
+    global last_engine
+    rec1,rec2 = np.asarray(rec1),np.asarray(rec2)
+    if engine == 'auto':
+        int_keys = (rec1.dtype.kind in 'iu') & (rec2.dtype.kind in 'iu')
+        int_keys = int_keys and (np.result_type(rec1,rec2).kind in 'iu')
+        size_ratio = max(len(rec1),len(rec2)) / max(min(len(rec1),len(rec2)),1)
+        engine = 'hash' if int_keys & (size_ratio >= hash_ratio) & (unique == False) else 'merge'
+    if engine not in ['hash','merge']:
+        raise ValueError("engine must be 'auto', 'hash', or 'merge', not {}".format(engine))
+    last_engine = engine
+    tmark.tm('Starting Join ({} engine)'.format(engine))
+    join_func = hash_join if engine == 'hash' else rec_join
+    return join_func(rec1,rec2,how=how,unique=unique,counts=counts)
+
+#Persistent PMF index for a catalog file. The sorted PMF keys and the sort
+#permutation (keys = mk_key(cat)[srt]) are saved next to the catalog as
+#<file>.pmf_keys.npy and <file>.pmf_srt.npy, with <file>.pmf_idx.json holding
+#the catalog's size and modification time. Later calls load them memory-mapped,
+#so nothing is read, hashed, or sorted again until the catalog file changes.
+#idx_dir puts the index somewhere else (for catalogs in read-only folders). If
+#the index can't be written, the freshly built one is still returned.
+def pmf_index_names(cat_file,idx_dir=None):
+    if idx_dir is None:
+        idx_base = cat_file
+    else:
+        idx_base = os.path.join(idx_dir,os.path.basename(cat_file))
+    return ['{}.pmf_keys.npy'.format(idx_base),'{}.pmf_srt.npy'.format(idx_base),
+            '{}.pmf_idx.json'.format(idx_base)]
+
+def pmf_index(cat_file,idx_dir=None,rebuild=False):
+    key_name,srt_name,meta_name = pmf_index_names(cat_file,idx_dir)
+    fstat = os.stat(cat_file)
+    meta = {'size':fstat.st_size,'mtime_ns':fstat.st_mtime_ns}
+    if (rebuild == False) & os.path.exists(meta_name):
+        try:
+            with open(meta_name) as mf:
+                old_meta = json.load(mf)
+            if old_meta == meta:
+                return np.load(key_name,mmap_mode='r'),np.load(srt_name,mmap_mode='r')
+        except (OSError,ValueError):
+            pass #Unreadable index, make a new one.
+    tmark.tm('Building PMF Index for {}'.format(cat_file))
+    with fits.open(cat_file,memmap=True) as hdul:
+        rec_key = mk_key(hdul[1].data)
+    srt = np.argsort(rec_key,kind='stable')
+    keys = rec_key[srt]
+    #The json goes last, so an index is only used once both arrays are written.
+    try:
+        if os.path.exists(meta_name):
+            os.remove(meta_name)
+        for fname,arr in [(key_name,keys),(srt_name,srt)]:
+            tmp_name = '{}.{}.tmp.npy'.format(fname[:-4],os.getpid())
+            np.save(tmp_name,arr)
+            os.replace(tmp_name,fname)
+        with open(meta_name,'w') as mf:
+            json.dump(meta,mf)
+    except OSError:
+        pass
+    return keys,srt
+
+#Positional (RA/DEC) cross-match, for the catalogs that don't share a PMF, like
+#the FIRST/2MASS/ROSAT/XMM/GAIA columns (and their SDSS2*_SEP separations) in
+#empty_cat_maker.multiwave_maker. Uses declination zones: catalog 2 is sorted by
+#(zone, RA) as one int64 key, and each object in catalog 1 looks up the RA range
+#the search circle covers in its own zone and the two next to it with
+#searchsorted. Only those candidates get an exact (haversine) separation. Objects
+#near RA=0/360 are copied to the other side so nothing is missed at the wrap, and
+#zones touching a pole search all RA. All in numpy, catalog 1 is done chunk_size
+#objects at a time to keep the candidate arrays small.
+#All angles in degrees, radius in arcseconds. nearest=True gives the closest
+#match within radius for each object in 1 that has one, nearest=False gives
+#every pair within radius. Returns adr1, adr2, and the separations in arcsec,
+#sorted by adr1 (then separation).
+zone_min = 1.0 / 60 #Smallest zone height in degrees, keeps the int64 keys in range.
+ra_bits = 48 #RA is stored to 1080/2^48 degrees (about 1.4e-8 arcsec) in the keys.
+def sky_sep(ra1,dec1,ra2,dec2):
+    ra1,dec1,ra2,dec2 = [np.radians(ang) for ang in [ra1,dec1,ra2,dec2]]
+    hav = (np.sin((dec2 - dec1) / 2)**2 +
+           np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2)**2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav,0,1)))) * 3600 #arcsec
+
+def zone_keys(zone,ra):
+    ra_int = np.floor((np.asarray(ra,dtype='f8') + 360.0) * (2**ra_bits / 1080.0)).astype('i8')
+    return zone.astype('i8') * 2**ra_bits + ra_int
+
+def sky_match(ra1,dec1,ra2,dec2,radius,nearest=True,chunk_size=200000):
+    ra1,dec1 = np.asarray(ra1,dtype='f8') % 360.0,np.asarray(dec1,dtype='f8')
+    ra2,dec2 = np.asarray(ra2,dtype='f8') % 360.0,np.asarray(dec2,dtype='f8')
+    rad_deg = radius / 3600.0
+    zone_h = max(rad_deg,zone_min)
+    num_zone = int(np.ceil(180.0 / zone_h))
+    #Half width in RA of the search circle for the worst dec in each zone (all
+    #RA for zones that get within radius of a pole).
+    zone_dec = np.minimum(np.maximum(np.abs(np.arange(num_zone) * zone_h - 90.0),
+                                     np.abs((np.arange(num_zone) + 1) * zone_h - 90.0)),90.0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        sin_dra = np.sin(np.radians(rad_deg)) / np.cos(np.radians(zone_dec))
+    zone_dra = np.where((zone_dec + rad_deg < 90.0) & (sin_dra < 1),
+                        np.degrees(np.arcsin(np.clip(sin_dra,0,1))) * 1.0000001 + 1.0e-9,180.0)
+    zone1 = np.clip(((dec1 + 90.0) / zone_h).astype('i8'),0,num_zone-1)
+    zone2 = np.clip(((dec2 + 90.0) / zone_h).astype('i8'),0,num_zone-1)
+    #Copies of catalog 2 across the RA wrap, as wide as any search into the zone.
+    pad_w = np.maximum(zone_dra,np.maximum(np.roll(zone_dra,1),np.roll(zone_dra,-1)))[zone2]
+    wlow,whigh = ra2 < pad_w,ra2 > 360.0 - pad_w
+    adr_all = np.concatenate((np.arange(len(ra2)),wlow.nonzero()[0],whigh.nonzero()[0]))
+    ra_all = np.concatenate((ra2,ra2[wlow] + 360.0,ra2[whigh] - 360.0))
+    key_all = zone_keys(zone2[adr_all],ra_all)
+    srt = np.argsort(key_all,kind='stable')
+    key_all,adr_all = key_all[srt],adr_all[srt]
+
+    out1,out2,out_sep = [],[],[]
+    for i in range(0,len(ra1),chunk_size):
+        cra,cdec,czone = ra1[i:i+chunk_size],dec1[i:i+chunk_size],zone1[i:i+chunk_size]
+        dra = zone_dra[czone]
+        for dz in [-1,0,1]:
+            zz = czone + dz
+            wz = (zz >= 0) & (zz < num_zone)
+            lo = np.searchsorted(key_all,zone_keys(zz[wz],cra[wz] - dra[wz]),side='left')
+            #A full circle in RA is half open, so an object isn't found twice.
+            hi_key = zone_keys(zz[wz],cra[wz] + dra[wz]) - (dra[wz] >= 180.0)
+            num_cand = np.searchsorted(key_all,hi_key,side='right') - lo
+            rep = np.repeat(np.arange(len(lo)),num_cand)
+            step = np.arange(len(rep)) - np.repeat(np.cumsum(num_cand) - num_cand,num_cand)
+            cand1 = wz.nonzero()[0][rep]
+            cand2 = adr_all[lo[rep] + step]
+            sep = sky_sep(cra[cand1],cdec[cand1],ra2[cand2],dec2[cand2])
+            wkeep = sep <= radius
+            out1.append(cand1[wkeep] + i)
+            out2.append(cand2[wkeep])
+            out_sep.append(sep[wkeep])
+    adr1 = np.concatenate(out1).astype('i8') if out1 else np.zeros(0,dtype='i8')
+    adr2 = np.concatenate(out2).astype('i8') if out2 else np.zeros(0,dtype='i8')
+    sep = np.concatenate(out_sep) if out_sep else np.zeros(0,dtype='f8')
+    order = np.lexsort((adr2,sep,adr1))
+    adr1,adr2,sep = adr1[order],adr2[order],sep[order]
+    if nearest == True:
+        wfirst = np.ones(len(adr1),dtype=bool)
+        wfirst[1:] = adr1[1:] != adr1[:-1]
+        adr1,adr2,sep = adr1[wfirst],adr2[wfirst],sep[wfirst]
+    return adr1,adr2,sep
+
+#Out-of-core PMF join for catalogs too big to match in memory. Both FITS files
+#are read a chunk at a time. Each chunk's PMF keys are sorted with their row
+#addresses and spilled to a temporary memory-mapped run file, the runs are
+#merged into one sorted (key, address) file per catalog, and the two sorted
+#files are merge-joined a block at a time with rec_join_sorted. The matched
+#pairs go to ofile, a .npy file of (ADR1, ADR2) rows (load it with
+#np.load(ofile,mmap_mode='r')); how works like rec_join, with -1 for no match.
+#mem_mb sets the memory budget (roughly, the arrays work on at most that much at
+#once); the temporary files go in tmp_dir (a new folder next to ofile by default)
+#and are removed at the end. Pairs come out in key order (for 'outer', the
+#unmatched rows of 2 come at the end of the block they were in). Returns ofile.
+ka_dtype = np.dtype([('KEY','<i8'),('ADR','<i8')])
+pair_dtype = np.dtype([('ADR1','<i8'),('ADR2','<i8')])
+ext_row_bytes = 64 #Working memory per row while sorting, roughly.
+
+#Sorted runs for one catalog. Returns the run file names, in row order.
+def ext_runs(cat_file,run_rows,tmp_dir,tag):
+    run_names = []
+    with fits.open(cat_file,memmap=True) as hdul:
+        cat_data = hdul[1].data
+        num_rec = len(cat_data)
+        for i in range(0,num_rec,run_rows):
+            chunk = cat_data[i:i+run_rows]
+            run = np.empty(len(chunk),dtype=ka_dtype)
+            chunk_key = mk_key(chunk)
+            srt = np.argsort(chunk_key,kind='stable')
+            run['KEY'],run['ADR'] = chunk_key[srt],srt + i
+            run_name = os.path.join(tmp_dir,'{}_run{:05d}.bin'.format(tag,len(run_names)))
+            run.tofile(run_name)
+            run_names.append(run_name)
+            del chunk,run,chunk_key,srt
+    return run_names
+
+def open_bin(fname):
+    if os.path.getsize(fname) == 0:
+        return np.zeros(0,dtype=ka_dtype)
+    return np.memmap(fname,dtype=ka_dtype,mode='r')
+
+#k-way merge of sorted runs into out_name, about block_rows rows at a time. Each
+#round takes a block from every run and writes out everything below the
+#smallest last key of the blocks that don't reach the end of their run; none of
+#those rows can be beaten by anything still waiting.
+def ext_merge(run_names,out_name,block_rows):
+    runs = [open_bin(run_name) for run_name in run_names]
+    blk = max(block_rows // max(len(runs),1),1024)
+    pos = [0] * len(runs)
+    with open(out_name,'wb') as out_file:
+        while any([p < len(run) for p,run in zip(pos,runs)]):
+            blocks = [run[p:p+blk] for p,run in zip(pos,runs)]
+            lasts = [blk_arr['KEY'][-1] for blk_arr,p,run in zip(blocks,pos,runs)
+                     if p + blk < len(run)]
+            takes = [len(blk_arr) for blk_arr in blocks]
+            if len(lasts) > 0:
+                thresh = min(lasts)
+                takes = [np.searchsorted(blk_arr['KEY'],thresh,side='left') for blk_arr in blocks]
+                if sum(takes) == 0: #Every waiting row has the threshold key.
+                    takes = [np.searchsorted(blk_arr['KEY'],thresh,side='right') for blk_arr in blocks]
+            merged = np.concatenate([blk_arr[:take] for blk_arr,take in zip(blocks,takes)])
+            #Stable, and the runs are in row order, so equal keys stay in row order.
+            merged[np.argsort(merged['KEY'],kind='stable')].tofile(out_file)
+            pos = [p + take for p,take in zip(pos,takes)]
+    del runs
+
+#Merge join of the two sorted (key, address) files into the pairs file.
+def ext_merge_join(srt_name1,srt_name2,pair_name,block_rows,how):
+    srt1,srt2 = open_bin(srt_name1),open_bin(srt_name2)
+    key_max = np.iinfo('i8').max
+    blk = max(block_rows,1024)
+    pos1,pos2,num_pairs = 0,0,0
+    with open(pair_name,'wb') as pair_file:
+        while (pos1 < len(srt1)) | (pos2 < len(srt2)):
+            blk1,blk2 = srt1[pos1:pos1+blk],srt2[pos2:pos2+blk]
+            last1 = blk1['KEY'][-1] if pos1 + blk < len(srt1) else key_max
+            last2 = blk2['KEY'][-1] if pos2 + blk < len(srt2) else key_max
+            thresh = min(last1,last2)
+            #Only keys below the threshold are complete on both sides.
+            side = 'right' if thresh == key_max else 'left'
+            take1 = np.searchsorted(blk1['KEY'],thresh,side=side)
+            take2 = np.searchsorted(blk2['KEY'],thresh,side=side)
+            if take1 + take2 == 0: #One key fills a whole block, so look further.
+                blk = 2 * blk
+                continue
+            adr1,adr2 = rec_join_sorted(np.array(blk1['KEY'][:take1]),np.array(blk1['ADR'][:take1]),
+                                        np.array(blk2['KEY'][:take2]),np.array(blk2['ADR'][:take2]),
+                                        how=how)
+            pairs = np.empty(len(adr1),dtype=pair_dtype)
+            pairs['ADR1'],pairs['ADR2'] = adr1,adr2
+            pairs.tofile(pair_file)
+            num_pairs += len(pairs)
+            pos1,pos2 = pos1 + take1,pos2 + take2
+    del srt1,srt2
+    return num_pairs
+
+def ext_join(cat_file1,cat_file2,ofile,how='inner',mem_mb=256,tmp_dir=None):
+    if how not in ['inner','left','outer']:
+        raise ValueError("how must be 'inner', 'left', or 'outer', not {}".format(how))
+    budget_rows = max(int(mem_mb * 2**20) // ext_row_bytes,1024)
+    work_dir = tempfile.mkdtemp(prefix='ext_join_',
+                                dir=tmp_dir if tmp_dir is not None else os.path.dirname(os.path.abspath(ofile)))
+    try:
+        srt_names = []
+        for tag,cat_file in [('cat1',cat_file1),('cat2',cat_file2)]:
+            tmark.tm('Sorting PMF Keys for {}'.format(cat_file))
+            run_names = ext_runs(cat_file,budget_rows,work_dir,tag)
+            srt_name = os.path.join(work_dir,'{}_sorted.bin'.format(tag))
+            ext_merge(run_names,srt_name,budget_rows)
+            for run_name in run_names:
+                os.remove(run_name)
+            srt_names.append(srt_name)
+        tmark.tm('Starting Out-of-core Join')
+        pair_name = os.path.join(work_dir,'pairs.bin')
+        num_pairs = ext_merge_join(srt_names[0],srt_names[1],pair_name,budget_rows // 4,how)
+        #Copy the pairs into a .npy file a block at a time.
+        pair_out = np.lib.format.open_memmap(ofile,mode='w+',dtype=pair_dtype,shape=(num_pairs,))
+        if num_pairs > 0:
+            pair_in = np.memmap(pair_name,dtype=pair_dtype,mode='r')
+            for i in range(0,num_pairs,budget_rows):
+                pair_out[i:i+budget_rows] = pair_in[i:i+budget_rows]
+            del pair_in
+        pair_out.flush()
+        del pair_out
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+    print('\n{} pairs written to: {}'.format(num_pairs,ofile))
+    return ofile
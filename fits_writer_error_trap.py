@@ -41,3 +41,18 @@ def nm_up(in_rec,in_name):
 
     #Tell me the final file name so I have a record of what was output.
     print('\nFile Written out as: {}'.format(out_name))
+    return out_name
+
+#Same naming scheme as nm_up, but only finds the name. Returns the first of
+#<in_name>.fits, <in_name>_00.fits, <in_name>_01.fits, ... that doesn't exist yet.
+#Used when the file is written some other way (streamed in chunks, for example).
+def nm_free(in_name):
+    out_name = '{}.fits'.format(in_name)
+    ver_num = 0
+    if len(glob.glob('{}*.fits'.format(in_name))) == 0:
+        return out_name
+    while True:
+        out_name = '{}_{:02d}.fits'.format(in_name,ver_num)
+        if len(glob.glob(out_name)) == 0:
+            return out_name
+        ver_num += 1
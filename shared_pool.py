@@ -0,0 +1,141 @@
+"""
+Runs a function over slices of large arrays with a pool of worker processes.
+The input and output arrays are put in shared memory once, and each worker only
+gets the names of the shared blocks and the row range it should work on, so no
+copies of the arrays are pickled and sent between processes.
+
+The function has to work element by element (row by row) so that splitting the
+rows up between workers gives exactly the same answer as running it serially.
+
+use in another program via
+import shared_pool as spl
+
+Parameters
+----------
+func : :class:'function'
+	A module level function (so it can be sent to the workers) that takes the
+    input arrays, sliced to the same rows, plus any keyword arguments. It must
+    return one array, or a tuple of arrays, one per output.
+in_arrs : :class:'list'
+	The input arrays. All must have the same length (first dimension).
+out_dtypes : :class:'list'
+	The numpy dtype of each output array. Outputs have the same length as the
+    inputs and are 1-D, unless the entry is a (dtype, number of columns) tuple.
+workers : :class:'int'
+	The number of worker processes.
+kwargs : :class:'dict'
+	OPTIONAL - keyword arguments passed to func in every worker.
+num_chunks : :class:'int'
+	OPTIONAL - the number of row ranges to split the work into. Defaults to four
+    per worker.
+pool : :class:'multiprocessing.Pool'
+	OPTIONAL - an open pool (see open_pool) to run on. Without one a new pool of
+    workers is started and stopped for this call only.
+
+Returns
+----------
+:class:'list'
+	The output arrays, in the same order as out_dtypes.
+"""
+import numpy as np
+import contextlib
+import sys
+from multiprocessing import Pool
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+#Python 3.13 added track=False, which stops a worker's resource tracker from
+#removing a block that the main process still owns.
+if sys.version_info >= (3,13):
+    shm_kw = {'track':False}
+else:
+    shm_kw = {}
+
+#Copies arr into a new shared memory block. Returns the block and a description
+#(name, shape, dtype) that a worker can use to find it.
+def to_shared(arr):
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+    desc = (shm.name,arr.shape,arr.dtype.str)
+    shared_view(shm,desc)[...] = arr
+    return shm,desc
+
+#Makes an empty shared block for an output array.
+def empty_shared(shape,dtype):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True,size=max(int(np.prod(shape))*dtype.itemsize,1))
+    return shm,(shm.name,shape,dtype.str)
+
+
+#Array view of a shared block from its description.
+def shared_view(shm,desc):
+    return np.ndarray(desc[1],dtype=desc[2],buffer=shm.buf)
+
+#Does the work for one row range. Kept separate from run_slice so every view
+#into the shared blocks is gone before the blocks are closed.
+def slice_work(func,in_blocks,in_descs,out_blocks,out_descs,start,stop,kwargs):
+    in_views = [shared_view(shm,desc)[start:stop] for shm,desc in zip(in_blocks,in_descs)]
+    res = func(*in_views,**kwargs)
+    if not isinstance(res,tuple):
+        res = (res,)
+    for shm,desc,res_arr in zip(out_blocks,out_descs,res):
+        shared_view(shm,desc)[start:stop] = res_arr
+
+#Runs in the worker. Attaches to the shared blocks, works on rows start to stop,
+#and writes into the outputs.
+def run_slice(task):
+    func,in_descs,out_descs,start,stop,kwargs = task
+    in_blocks = [shared_memory.SharedMemory(name=desc[0],**shm_kw) for desc in in_descs]
+    out_blocks = [shared_memory.SharedMemory(name=desc[0],**shm_kw) for desc in out_descs]
+    try:
+        slice_work(func,in_blocks,in_descs,out_blocks,out_descs,start,stop,kwargs)
+    finally:
+        for shm in in_blocks + out_blocks:
+            shm.close()
+    return stop - start
+
+#Opens a pool that can be given to several pool_run calls, so the cost of
+#starting the workers is paid once rather than on every call. Use it in a with
+#statement; with workers <= 1 it gives None (run serially).
+def open_pool(workers):
+    if workers > 1:
+        #Start the resource tracker before the workers fork so they share it,
+        #rather than each starting its own that tries to remove the blocks.
+        resource_tracker.ensure_running()
+        return Pool(workers)
+    return contextlib.nullcontext()
+
+def pool_run(func,in_arrs,out_dtypes,workers,kwargs=None,num_chunks=None,pool=None):
+    if kwargs is None:
+        kwargs = {}
+    num_rec = len(in_arrs[0])
+    if num_chunks is None:
+        num_chunks = 4 * workers
+    edges = np.linspace(0,num_rec,num_chunks+1).astype('i8')
+    blocks,in_descs,out_descs = [],[],[]
+    try:
+        for arr in in_arrs:
+            shm,desc = to_shared(arr)
+            blocks.append(shm)
+            in_descs.append(desc)
+        for dtype in out_dtypes:
+            if isinstance(dtype,tuple):
+                shm,desc = empty_shared((num_rec,dtype[1]),dtype[0])
+            else:
+                shm,desc = empty_shared((num_rec,),dtype)
+            blocks.append(shm)
+            out_descs.append(desc)
+        tasks = [(func,in_descs,out_descs,edges[i],edges[i+1],kwargs)
+                 for i in range(num_chunks) if edges[i+1] > edges[i]]
+        if pool is None:
+            with Pool(workers) as new_pool:
+                new_pool.map(run_slice,tasks)
+        else:
+            pool.map(run_slice,tasks)
+        #Copy the outputs out of shared memory before the blocks are removed.
+        out_arrs = [shared_view(shm,desc).copy() for shm,desc in zip(blocks[len(in_arrs):],out_descs)]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return out_arrs